@@ -0,0 +1,19 @@
+# Generated by Django 4.2.21 on 2026-10-16 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("anagrafica", "0003_alter_fornitore_partita_iva"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="fornitore",
+            index=models.Index(
+                fields=["attivo", "nome", "id"], name="anagrafica__attivo_e29a6d_idx"
+            ),
+        ),
+    ]
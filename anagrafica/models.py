@@ -355,6 +355,10 @@ class Fornitore(models.Model):
         verbose_name = "Fornitore"
         verbose_name_plural = "Fornitori"
         ordering = ['nome']
+        indexes = [
+            # Copre l'elenco dei fornitori attivi ordinato per nome
+            models.Index(fields=['attivo', 'nome', 'id']),
+        ]
     
     def __str__(self):
         return self.nome
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.21 on 2026-10-16 11:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def collega_documenti(apps, schema_editor):
+    """
+    Collega i promemoria automatici già esistenti al documento da cui sono
+    stati generati (titolo "<URGENZA>: <nome documento> in scadenza").
+    """
+    Promemoria = apps.get_model('core', 'Promemoria')
+    DocStabilimento = apps.get_model('stabilimenti', 'DocStabilimento')
+
+    documenti = {}
+    for pk, nome, data_scadenza in DocStabilimento.objects.filter(
+        data_scadenza__isnull=False
+    ).order_by('pk').values_list('pk', 'nome_documento', 'data_scadenza'):
+        documenti.setdefault((data_scadenza, nome.lower()), pk)
+
+    da_aggiornare = []
+    for promemoria in Promemoria.objects.filter(
+        documento__isnull=True,
+        data_scadenza__isnull=False,
+        titolo__endswith=' in scadenza'
+    ).only('pk', 'titolo', 'data_scadenza').iterator():
+        nome = promemoria.titolo.partition(': ')[2].removesuffix(' in scadenza')
+        documento_id = documenti.get((promemoria.data_scadenza, nome.lower()))
+        if documento_id:
+            promemoria.documento_id = documento_id
+            da_aggiornare.append(promemoria)
+
+    Promemoria.objects.bulk_update(da_aggiornare, ['documento'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0002_remove_stabilimento_stabiliment_attivo_5a5210_idx_and_more"),
+        ("core", "0003_promemoria_messaggio"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="promemoria",
+            name="documento",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="promemoria",
+                to="stabilimenti.docstabilimento",
+                verbose_name="Documento",
+            ),
+        ),
+        # Popola il nuovo campo per i promemoria generati in precedenza
+        migrations.RunPython(collega_documenti, reverse_code=migrations.RunPython.noop),
+    ]
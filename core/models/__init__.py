@@ -92,6 +92,15 @@ class Promemoria(models.Model):
     
     creato_da = models.ForeignKey(User, on_delete=models.CASCADE, related_name='promemoria_creati', verbose_name=_('Creato da'))
     assegnato_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='promemoria_assegnati', verbose_name=_('Assegnato a'))
+    # Documento che ha generato il promemoria (promemoria automatici delle scadenze)
+    documento = models.ForeignKey(
+        'stabilimenti.DocStabilimento',
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name='promemoria',
+        verbose_name=_('Documento')
+    )
     
     class Meta:
         verbose_name = _('Promemoria')
@@ -51,6 +51,15 @@ else
 fi
 echo ""
 
+# Redis per la cache condivisa tra i worker (imposta REDIS_URL)
+if heroku addons:info heroku-redis -a $APP_NAME &> /dev/null; then
+    echo -e "${GREEN}✓ Redis già configurato${NC}"
+else
+    echo "Aggiunta addon Redis..."
+    heroku addons:create heroku-redis:mini -a $APP_NAME
+fi
+echo ""
+
 # 6. Configura variabili d'ambiente
 echo -e "${YELLOW}6. Configurazione variabili d'ambiente...${NC}"
 
@@ -3,6 +3,7 @@ Heroku Production Settings
 """
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from .settings import *
 
 # Security Settings
@@ -23,6 +24,22 @@ DATABASES = {
     )
 }
 
+# Cache condivisa tra i worker gunicorn: le chiavi versionate delle
+# dashboard e delle choices devono essere viste da tutti i processi
+REDIS_URL = os.getenv('REDIS_URL')
+if not REDIS_URL:
+    raise ImproperlyConfigured('REDIS_URL non impostata: serve per la cache condivisa')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+# Heroku Redis usa TLS con certificato self-signed
+if REDIS_URL.startswith('rediss://'):
+    CACHES['default']['OPTIONS'] = {'ssl_cert_reqs': None}
+
 # Static files (CSS, JavaScript, Images)
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATIC_URL = '/static/'
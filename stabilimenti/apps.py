@@ -9,8 +9,11 @@ class StabilimentiConfig(AppConfig):
     def ready(self):
         """
         Chiamato quando l'app è pronta.
-        Registra automaticamente il modello Stabilimento come target procurement.
+        Registra i signal handlers e il modello Stabilimento come target procurement.
         """
+        # Signal per l'invalidazione della cache delle choices
+        from . import signals
+        
         try:
             from core.registry import procurement_target_registry
             from .models import Stabilimento
@@ -0,0 +1,89 @@
+"""
+Cache dell'app stabilimenti: chiavi e invalidazione.
+
+Le chiavi contengono la versione del gruppo di dati a cui appartengono,
+salvata anch'essa in cache. Per invalidare si incrementa la versione
+invece di cancellare le chiavi: le voci vecchie non vengono più lette e
+scadono da sole. Con una cache condivisa tra i processi (vedi CACHES in
+settings_heroku) la nuova versione vale subito per tutti i worker.
+"""
+import time
+
+from django.core.cache import cache
+
+
+# =====================================
+# VERSIONI
+# =====================================
+
+def _chiave_versione(gruppo):
+    return f'stabilimenti:versione:{gruppo}'
+
+
+def versione(gruppo):
+    """
+    Versione corrente delle chiavi di un gruppo di dati. Se manca (prima
+    lettura o chiave espulsa dalla cache) riparte dall'istante attuale in
+    nanosecondi, diverso da tutte le versioni usate in precedenza
+    """
+    chiave = _chiave_versione(gruppo)
+    valore = cache.get(chiave)
+    if valore is None:
+        valore = time.time_ns()
+        if not cache.add(chiave, valore, None):
+            # Creata nel frattempo da un'altra richiesta
+            valore = cache.get(chiave, valore)
+    return valore
+
+
+def incrementa_versione(gruppo):
+    """Rende obsolete tutte le chiavi del gruppo"""
+    try:
+        cache.incr(_chiave_versione(gruppo))
+    except ValueError:
+        # Versione non ancora in cache: la prossima lettura ne crea una nuova
+        pass
+
+
+# =====================================
+# DASHBOARD E DETTAGLIO
+# =====================================
+
+DASHBOARD_CACHE_TIMEOUT = 60  # secondi
+
+
+def chiave_dashboard(nome, oggi):
+    """Chiave in cache dei dati di una dashboard per la data indicata"""
+    return f'stabilimenti:dashboard:{nome}:{oggi.isoformat()}:{versione("dashboard")}'
+
+
+def invalida_dashboard_cache():
+    """Rende obsoleti i dati in cache di statistiche lista, dashboard scadenze e utenze"""
+    incrementa_versione('dashboard')
+
+
+def chiave_dettaglio(pk, oggi):
+    """Chiave in cache delle sezioni del dettaglio di uno stabilimento"""
+    return f'stabilimenti:dettaglio:{pk}:{oggi.isoformat()}:{versione(f"dettaglio:{pk}")}'
+
+
+def invalida_dettaglio_cache(pk):
+    """Rende obsolete le sezioni in cache del dettaglio di uno stabilimento"""
+    incrementa_versione(f'dettaglio:{pk}')
+
+
+# =====================================
+# CONTEGGI PAGINAZIONE
+# =====================================
+
+CONTEGGI_CACHE_TIMEOUT = 60  # secondi
+
+
+def chiave_conteggio(impronta):
+    """Chiave in cache del COUNT di una query, identificata dall'impronta dell'SQL"""
+    return f'stabilimenti:conteggio:{versione("conteggi")}:{impronta}'
+
+
+def invalida_conteggi_cache():
+    """Rende obsoleti tutti i conteggi in cache"""
+    incrementa_versione('conteggi')
@@ -1,24 +1,238 @@
 from django import forms
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
 from django.forms import modelformset_factory, inlineformset_factory
 from django.utils import timezone
 from decimal import Decimal
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column, Field, HTML, Div, Fieldset
 from crispy_forms.bootstrap import InlineCheckboxes, PrependedText, AppendedText, Alert
+import os
+from collections import ChainMap
 from datetime import date, timedelta
+from functools import lru_cache
+from types import MappingProxyType
 from django.contrib.auth import get_user_model
 
+from .cache import versione, incrementa_versione
 from .models import Stabilimento, CostiStabilimento, DocStabilimento
 from anagrafica.models import Fornitore
 
 User = get_user_model()
 
 
+# =====================================
+# COSTANTI DI VALIDAZIONE
+# =====================================
+
+# Limiti ammessi per l'importo dei costi
+_MIN_IMPORTO = Decimal('0.01')
+_MAX_IMPORTO = Decimal('9999999.99')
+
+# Limiti per i file caricati (allineati agli attributi 'accept' dei widget)
+_MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+_ESTENSIONI_AMMESSE = frozenset({'.pdf', '.doc', '.docx', '.jpg', '.jpeg', '.png'})
+_ESTENSIONI_DOCUMENTI = _ESTENSIONI_AMMESSE | {'.dwg'}
+
+
+def _valida_upload(file, estensioni=_ESTENSIONI_AMMESSE):
+    """
+    Rifiuta subito i file troppo grandi o con estensione non ammessa.
+    I file già salvati (modifica senza nuovo upload) non vengono ricontrollati.
+    """
+    if not isinstance(file, UploadedFile):
+        return file
+    if file.size > _MAX_UPLOAD_SIZE:
+        raise ValidationError(
+            f"File troppo grande. Dimensione massima consentita: {_MAX_UPLOAD_SIZE // (1024 * 1024)}MB"
+        )
+    if os.path.splitext(file.name)[1].lower() not in estensioni:
+        raise ValidationError(
+            f"Estensione file non consentita. Formati ammessi: {', '.join(sorted(estensioni))}"
+        )
+    return file
+
+
+# =====================================
+# ATTRIBUTI WIDGET CONDIVISI
+# =====================================
+
+# Mapping immutabili: i widget ne fanno comunque una copia in __init__
+_SELECT_ATTRS = MappingProxyType({'class': 'form-select'})
+_DATE_ATTRS = MappingProxyType({'class': 'form-control', 'type': 'date'})
+_FILE_ATTRS = MappingProxyType({
+    'class': 'form-control',
+    'accept': '.pdf,.doc,.docx,.jpg,.jpeg,.png'
+})
+
+# Django clona i widget quando costruisce i campi, le istanze possono essere condivise
+_SELECT_WIDGET = forms.Select(attrs=_SELECT_ATTRS)
+_DATE_WIDGET = forms.DateInput(attrs=_DATE_ATTRS)
+
+
+# =====================================
+# CHOICES IN CACHE PER LE SELECT
+# =====================================
+
+CHOICES_CACHE_TIMEOUT = 300  # secondi
+
+# Colonne lette da _etichetta_utente per costruire le etichette delle select.
+# Nessuna etichetta attraversa relazioni (niente select_related necessario):
+# se un'etichetta dovesse leggere una FK, aggiungere qui le colonne
+# 'relazione__campo' e il relativo select_related nei queryset.
+_USER_LABEL_FIELDS = ('id', 'username', 'first_name', 'last_name')
+
+
+def _etichetta_utente(user):
+    """Etichetta di un utente nelle select (solo colonne già caricate)"""
+    return f"{user.first_name} {user.last_name}".strip() or user.username
+
+CHOICES_CACHE_KEYS = {
+    'stabilimenti': 'stabilimenti:choices:stabilimenti',
+    'fornitori': 'stabilimenti:choices:fornitori',
+    'responsabili': 'stabilimenti:choices:responsabili',
+}
+
+
+def _choices_versionate(nome, carica):
+    """
+    Choices in cache con la versione del gruppo nella chiave: i signal
+    incrementano la versione, senza query per verificare se i dati
+    sono cambiati.
+    """
+    chiave = f"{CHOICES_CACHE_KEYS[nome]}:{versione(f'choices:{nome}')}"
+    return cache.get_or_set(chiave, carica, CHOICES_CACHE_TIMEOUT)
+
+
+def stabilimenti_choices():
+    """Coppie (pk, etichetta) degli stabilimenti attivi, lette dalla cache"""
+    return _choices_versionate(
+        'stabilimenti',
+        lambda: [
+            (pk, f"{codice} - {nome}")
+            for pk, codice, nome in Stabilimento.objects.attivi().order_by('nome').values_list(
+                'pk', 'codice_stabilimento', 'nome'
+            )
+        ]
+    )
+
+
+def fornitori_choices():
+    """Coppie (pk, nome) dei fornitori attivi, lette dalla cache"""
+    return _choices_versionate(
+        'fornitori',
+        lambda: list(
+            Fornitore.objects.filter(attivo=True).order_by('nome').values_list('pk', 'nome')
+        )
+    )
+
+
+def responsabili_choices():
+    """Coppie (pk, etichetta) degli utenti attivi, lette dalla cache"""
+    return _choices_versionate(
+        'responsabili',
+        lambda: [
+            (user.pk, _etichetta_utente(user))
+            for user in User.objects.filter(is_active=True).only(
+                *_USER_LABEL_FIELDS
+            ).order_by('first_name', 'last_name')
+        ]
+    )
+
+
+def invalida_choices_cache(*nomi):
+    """Rende obsolete le choices in cache dei gruppi indicati (tutti se nessuno)"""
+    for nome in nomi or CHOICES_CACHE_KEYS:
+        incrementa_versione(f'choices:{nome}')
+
+
+def _istanza_selezionata(model, pk):
+    """Converte il pk scelto in una select nell'istanza del modello"""
+    if pk in (None, ''):
+        return None
+    istanza = model._default_manager.filter(pk=pk).first()
+    if istanza is None:
+        raise ValidationError("Seleziona una scelta valida.")
+    return istanza
+
+
+@lru_cache(maxsize=1)
+def _anni_choices(anno_corrente):
+    """Choices degli ultimi 5 anni, ricalcolate solo al cambio d'anno"""
+    return [('', 'Tutti gli anni')] + [
+        (str(anno), str(anno)) for anno in range(anno_corrente, anno_corrente - 5, -1)
+    ]
+
+
+def _crea_helper(layout, form_method='post', form_enctype=None):
+    """
+    Crea un FormHelper a partire da un layout statico.
+    Il layout non viene modificato in fase di render, quindi l'helper
+    può essere condiviso da tutte le istanze del form.
+    """
+    helper = FormHelper()
+    helper.form_method = form_method
+    if form_enctype:
+        helper.form_enctype = form_enctype
+    helper.layout = layout
+    return helper
+
+
 # =====================================
 # FORM PRINCIPALE STABILIMENTO
 # =====================================
 
+def _helper_stabilimento(con_codice):
+    """Helper Crispy di StabilimentoForm, con o senza il campo codice"""
+    dati_principali = [Column('nome', css_class='form-group col-md-8')]
+    if con_codice:
+        dati_principali.append(Column('codice_stabilimento', css_class='form-group col-md-4'))
+    
+    return _crea_helper(Layout(
+        Alert(
+            content="Compila i dati dello stabilimento. I campi contrassegnati con * sono obbligatori.",
+            css_class="alert-info"
+        ),
+        Fieldset(
+            'Dati Anagrafici',
+            Row(*dati_principali),
+            Row(
+                Column('indirizzo', css_class='form-group col-md-12'),
+            ),
+            Row(
+                Column('cap', css_class='form-group col-md-2'),
+                Column('citta', css_class='form-group col-md-6'),
+                Column('provincia', css_class='form-group col-md-2'),
+            ),
+            Row(
+                Column('telefono', css_class='form-group col-md-6'),
+                Column('email_filiale', css_class='form-group col-md-6'),
+            )
+        ),
+        Fieldset(
+            'Responsabili',
+            Row(
+                Column('responsabile_operativo', css_class='form-group col-md-6'),
+                Column('responsabile_amministrativo', css_class='form-group col-md-6'),
+            )
+        ),
+        Fieldset(
+            'Caratteristiche Strutturali',
+            Row(
+                Column('superficie_mq', css_class='form-group col-md-4'),
+                Column('numero_piani', css_class='form-group col-md-4'),
+                Column('anno_costruzione', css_class='form-group col-md-4'),
+            ),
+            'data_apertura'
+        ),
+        Fieldset(
+            'Note',
+            'note_generali'
+        )
+    ))
+
+
 class StabilimentoForm(forms.ModelForm):
     """
     Form principale per la creazione/modifica di uno stabilimento.
@@ -74,12 +288,8 @@ class StabilimentoForm(forms.ModelForm):
                 'class': 'form-control',
                 'placeholder': 'stabilimento@azienda.it'
             }),
-            'responsabile_operativo': forms.Select(attrs={
-                'class': 'form-select'
-            }),
-            'responsabile_amministrativo': forms.Select(attrs={
-                'class': 'form-select'
-            }),
+            'responsabile_operativo': _SELECT_WIDGET,
+            'responsabile_amministrativo': _SELECT_WIDGET,
             'superficie_mq': forms.NumberInput(attrs={
                 'class': 'form-control',
                 'min': '1'
@@ -94,10 +304,7 @@ class StabilimentoForm(forms.ModelForm):
                 'min': '1800',
                 'max': timezone.now().year
             }),
-            'data_apertura': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
+            'data_apertura': _DATE_WIDGET,
             'note_generali': forms.Textarea(attrs={
                 'class': 'form-control',
                 'rows': 4,
@@ -105,21 +312,30 @@ class StabilimentoForm(forms.ModelForm):
             })
         }
     
+    # Layout Crispy statici: senza codice (nuovo) e con codice (modifica)
+    _HELPER_NUOVO = _helper_stabilimento(con_codice=False)
+    _HELPER_MODIFICA = _helper_stabilimento(con_codice=True)
+    
     def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = user
         
-        # Configura queryset utenti attivi
-        self.fields['responsabile_operativo'].queryset = User.objects.filter(
-            is_active=True
-        ).order_by('first_name', 'last_name', 'username')
-        self.fields['responsabile_amministrativo'].queryset = User.objects.filter(
+        # Configura queryset utenti attivi (usato solo per validare la scelta)
+        utenti_attivi = User.objects.filter(
             is_active=True
-        ).order_by('first_name', 'last_name', 'username')
+        ).only(*_USER_LABEL_FIELDS).order_by('first_name', 'last_name', 'username')
+        self.fields['responsabile_operativo'].queryset = utenti_attivi
+        self.fields['responsabile_amministrativo'].queryset = utenti_attivi
         
-        # Empty labels
-        self.fields['responsabile_operativo'].empty_label = "Seleziona responsabile operativo"
-        self.fields['responsabile_amministrativo'].empty_label = "Seleziona responsabile amministrativo"
+        # Le due select mostrano gli stessi utenti: choices lette una sola volta
+        # (dalla cache) invece di ripetere la stessa query per ciascun campo
+        responsabili = responsabili_choices()
+        self.fields['responsabile_operativo'].choices = [
+            ('', "Seleziona responsabile operativo")
+        ] + responsabili
+        self.fields['responsabile_amministrativo'].choices = [
+            ('', "Seleziona responsabile amministrativo")
+        ] + responsabili
         
         # Precompila con utente corrente se nuovo stabilimento
         if not self.instance.pk and user:
@@ -147,57 +363,8 @@ class StabilimentoForm(forms.ModelForm):
         self.fields['superficie_mq'].help_text = "Superficie totale in metri quadrati"
         self.fields['anno_costruzione'].help_text = "Anno di costruzione dell'edificio"
         
-        # Setup Crispy Forms
-        self.helper = FormHelper()
-        self.helper.form_method = 'post'
-        self.helper.layout = Layout(
-            Alert(
-                content="Compila i dati dello stabilimento. I campi contrassegnati con * sono obbligatori.",
-                css_class="alert-info"
-            ),
-            Fieldset(
-                'Dati Anagrafici',
-                Row(
-                    Column('nome', css_class='form-group col-md-8'),
-                    Column('codice_stabilimento', css_class='form-group col-md-4') if self.instance.pk else None,
-                ),
-                Row(
-                    Column('indirizzo', css_class='form-group col-md-12'),
-                ),
-                Row(
-                    Column('cap', css_class='form-group col-md-2'),
-                    Column('citta', css_class='form-group col-md-6'),
-                    Column('provincia', css_class='form-group col-md-2'),
-                ),
-                Row(
-                    Column('telefono', css_class='form-group col-md-6'),
-                    Column('email_filiale', css_class='form-group col-md-6'),
-                )
-            ),
-            Fieldset(
-                'Responsabili',
-                Row(
-                    Column('responsabile_operativo', css_class='form-group col-md-6'),
-                    Column('responsabile_amministrativo', css_class='form-group col-md-6'),
-                )
-            ),
-            Fieldset(
-                'Caratteristiche Strutturali',
-                Row(
-                    Column('superficie_mq', css_class='form-group col-md-4'),
-                    Column('numero_piani', css_class='form-group col-md-4'),
-                    Column('anno_costruzione', css_class='form-group col-md-4'),
-                ),
-                'data_apertura'
-            ),
-            Fieldset(
-                'Note',
-                'note_generali'
-            )
-        )
-        
-        # Rimuovi campi None dal layout
-        self.helper.layout.fields = [f for f in self.helper.layout.fields if f is not None]
+        # Setup Crispy Forms (il codice stabilimento compare solo in modifica)
+        self.helper = self._HELPER_MODIFICA if self.instance.pk else self._HELPER_NUOVO
     
     def clean_provincia(self):
         """Validazione provincia"""
@@ -235,6 +402,16 @@ class CostiStabilimentoForm(forms.ModelForm):
     Form per la gestione dei costi di stabilimento.
     """
     
+    # Select alimentate dalle choices in cache (vedi stabilimenti_choices/fornitori_choices)
+    stabilimento = forms.TypedChoiceField(
+        coerce=int,
+        widget=_SELECT_WIDGET
+    )
+    fornitore = forms.TypedChoiceField(
+        coerce=int,
+        widget=_SELECT_WIDGET
+    )
+    
     class Meta:
         model = CostiStabilimento
         fields = [
@@ -257,10 +434,8 @@ class CostiStabilimentoForm(forms.ModelForm):
             'note_interne'
         ]
         widgets = {
-            'stabilimento': forms.Select(attrs={'class': 'form-select'}),
-            'fornitore': forms.Select(attrs={'class': 'form-select'}),
-            'causale': forms.Select(attrs={'class': 'form-select'}),
-            'stato': forms.Select(attrs={'class': 'form-select'}),
+            'causale': _SELECT_WIDGET,
+            'stato': _SELECT_WIDGET,
             'titolo': forms.TextInput(attrs={
                 'class': 'form-control',
                 'placeholder': 'Titolo dell\'intervento o servizio'
@@ -282,38 +457,14 @@ class CostiStabilimentoForm(forms.ModelForm):
                 'max': '100',
                 'value': '22'
             }),
-            'data_richiesta': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'data_inizio_lavori': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'data_fine_lavori': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'data_fattura': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'data_scadenza_servizio': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'preventivo': forms.FileInput(attrs={
-                'class': 'form-control',
-                'accept': '.pdf,.doc,.docx,.jpg,.jpeg,.png'
-            }),
-            'fattura': forms.FileInput(attrs={
-                'class': 'form-control',
-                'accept': '.pdf,.doc,.docx,.jpg,.jpeg,.png'
-            }),
-            'certificato': forms.FileInput(attrs={
-                'class': 'form-control',
-                'accept': '.pdf,.doc,.docx,.jpg,.jpeg,.png'
-            }),
+            'data_richiesta': _DATE_WIDGET,
+            'data_inizio_lavori': _DATE_WIDGET,
+            'data_fine_lavori': _DATE_WIDGET,
+            'data_fattura': _DATE_WIDGET,
+            'data_scadenza_servizio': _DATE_WIDGET,
+            'preventivo': forms.FileInput(attrs=_FILE_ATTRS),
+            'fattura': forms.FileInput(attrs=_FILE_ATTRS),
+            'certificato': forms.FileInput(attrs=_FILE_ATTRS),
             'note_interne': forms.Textarea(attrs={
                 'class': 'form-control',
                 'rows': 3,
@@ -321,47 +472,9 @@ class CostiStabilimentoForm(forms.ModelForm):
             })
         }
     
-    def __init__(self, *args, user=None, stabilimento=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.user = user
-        
-        # Configura queryset
-        self.fields['stabilimento'].queryset = Stabilimento.objects.attivi().order_by('nome')
-        self.fields['fornitore'].queryset = Fornitore.objects.filter(attivo=True).order_by('nome')
-        
-        # Preseleziona stabilimento se specificato
-        if stabilimento and not self.instance.pk:
-            self.fields['stabilimento'].initial = stabilimento
-        
-        # Labels
-        self.fields['stabilimento'].label = "Stabilimento *"
-        self.fields['fornitore'].label = "Fornitore *"
-        self.fields['causale'].label = "Tipologia Costo *"
-        self.fields['stato'].label = "Stato Pratica *"
-        self.fields['titolo'].label = "Titolo *"
-        self.fields['descrizione'].label = "Descrizione *"
-        self.fields['importo'].label = "Importo (€) *"
-        self.fields['iva_percentuale'].label = "IVA %"
-        self.fields['data_richiesta'].label = "Data Richiesta"
-        self.fields['data_inizio_lavori'].label = "Data Inizio Lavori"
-        self.fields['data_fine_lavori'].label = "Data Fine Lavori"
-        self.fields['data_fattura'].label = "Data Fattura"
-        self.fields['data_scadenza_servizio'].label = "Prossima Scadenza"
-        self.fields['preventivo'].label = "File Preventivo"
-        self.fields['fattura'].label = "File Fattura"
-        self.fields['certificato'].label = "Certificato/Documento"
-        self.fields['note_interne'].label = "Note Interne"
-        
-        # Help text
-        self.fields['data_scadenza_servizio'].help_text = "Data del prossimo intervento o scadenza certificazione"
-        self.fields['importo'].help_text = "Importo senza IVA"
-        self.fields['note_interne'].help_text = "Note visibili solo internamente"
-        
-        # Setup Crispy Forms
-        self.helper = FormHelper()
-        self.helper.form_method = 'post'
-        self.helper.form_enctype = 'multipart/form-data'
-        self.helper.layout = Layout(
+    # Layout Crispy statico, costruito una sola volta al caricamento della classe
+    _HELPER = _crea_helper(
+        Layout(
             Alert(
                 content="Inserisci i dettagli del costo/servizio per lo stabilimento.",
                 css_class="alert-info"
@@ -410,31 +523,104 @@ class CostiStabilimentoForm(forms.ModelForm):
                 'Note',
                 'note_interne'
             )
-        )
+        ),
+        form_enctype='multipart/form-data'
+    )
+    
+    def __init__(self, *args, user=None, stabilimento=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        
+        # Configura choices
+        self.fields['stabilimento'].choices = [('', '---------')] + stabilimenti_choices()
+        self.fields['fornitore'].choices = [('', '---------')] + fornitori_choices()
+        
+        # Preseleziona stabilimento se specificato
+        if stabilimento and not self.instance.pk:
+            self.fields['stabilimento'].initial = stabilimento.pk
+        
+        # Labels
+        self.fields['stabilimento'].label = "Stabilimento *"
+        self.fields['fornitore'].label = "Fornitore *"
+        self.fields['causale'].label = "Tipologia Costo *"
+        self.fields['stato'].label = "Stato Pratica *"
+        self.fields['titolo'].label = "Titolo *"
+        self.fields['descrizione'].label = "Descrizione *"
+        self.fields['importo'].label = "Importo (€) *"
+        self.fields['iva_percentuale'].label = "IVA %"
+        self.fields['data_richiesta'].label = "Data Richiesta"
+        self.fields['data_inizio_lavori'].label = "Data Inizio Lavori"
+        self.fields['data_fine_lavori'].label = "Data Fine Lavori"
+        self.fields['data_fattura'].label = "Data Fattura"
+        self.fields['data_scadenza_servizio'].label = "Prossima Scadenza"
+        self.fields['preventivo'].label = "File Preventivo"
+        self.fields['fattura'].label = "File Fattura"
+        self.fields['certificato'].label = "Certificato/Documento"
+        self.fields['note_interne'].label = "Note Interne"
+        
+        # Help text
+        self.fields['data_scadenza_servizio'].help_text = "Data del prossimo intervento o scadenza certificazione"
+        self.fields['importo'].help_text = "Importo senza IVA"
+        self.fields['note_interne'].help_text = "Note visibili solo internamente"
+        
+        # Setup Crispy Forms (helper condiviso a livello di classe)
+        self.helper = self._HELPER
+    
+    def clean_stabilimento(self):
+        """Converte lo stabilimento scelto nell'istanza del modello"""
+        return _istanza_selezionata(Stabilimento, self.cleaned_data.get('stabilimento'))
+    
+    def clean_fornitore(self):
+        """Converte il fornitore scelto nell'istanza del modello"""
+        return _istanza_selezionata(Fornitore, self.cleaned_data.get('fornitore'))
+    
+    def clean_preventivo(self):
+        """Validazione dimensione/estensione del preventivo"""
+        return _valida_upload(self.cleaned_data.get('preventivo'))
+    
+    def clean_fattura(self):
+        """Validazione dimensione/estensione della fattura"""
+        return _valida_upload(self.cleaned_data.get('fattura'))
+    
+    def clean_certificato(self):
+        """Validazione dimensione/estensione del certificato"""
+        return _valida_upload(self.cleaned_data.get('certificato'))
     
     def clean_importo(self):
         """Validazione importo"""
         importo = self.cleaned_data.get('importo')
-        if importo and importo <= 0:
-            raise ValidationError("L'importo deve essere maggiore di zero")
-        if importo and importo > Decimal('9999999.99'):
+        if importo is None:
+            return importo
+        if not (_MIN_IMPORTO <= importo <= _MAX_IMPORTO):
+            if importo < _MIN_IMPORTO:
+                raise ValidationError("L'importo deve essere maggiore di zero")
             raise ValidationError("L'importo non può superare 9.999.999,99 euro")
         return importo
     
     def clean(self):
         """Validazioni incrociate"""
         cleaned_data = super().clean()
-        data_inizio = cleaned_data.get('data_inizio_lavori')
-        data_fine = cleaned_data.get('data_fine_lavori')
-        data_richiesta = cleaned_data.get('data_richiesta')
+        get = cleaned_data.get
+        data_inizio, data_fine, data_richiesta = (
+            get('data_inizio_lavori'), get('data_fine_lavori'), get('data_richiesta')
+        )
+        
+        # Entrambi i controlli richiedono la data di inizio lavori
+        if data_inizio is None:
+            return cleaned_data
+        
+        errors = []
         
         # Verifica date lavori
-        if data_inizio and data_fine and data_inizio > data_fine:
-            raise ValidationError("La data di fine lavori non può essere precedente all'inizio")
+        if data_fine and data_inizio > data_fine:
+            errors.append(ValidationError("La data di fine lavori non può essere precedente all'inizio"))
         
         # Verifica data richiesta
-        if data_richiesta and data_inizio and data_richiesta > data_inizio:
-            raise ValidationError("La data di richiesta non può essere successiva all'inizio lavori")
+        if data_richiesta and data_richiesta > data_inizio:
+            errors.append(ValidationError("La data di richiesta non può essere successiva all'inizio lavori"))
+        
+        if errors:
+            raise ValidationError(errors)
         
         return cleaned_data
 
@@ -448,6 +634,11 @@ class DocStabilimentoForm(forms.ModelForm):
     Form per la gestione dei documenti di stabilimento.
     """
     
+    stabilimento = forms.TypedChoiceField(
+        coerce=int,
+        widget=_SELECT_WIDGET
+    )
+    
     class Meta:
         model = DocStabilimento
         fields = [
@@ -462,12 +653,11 @@ class DocStabilimentoForm(forms.ModelForm):
             'note'
         ]
         widgets = {
-            'stabilimento': forms.Select(attrs={'class': 'form-select'}),
             'nome_documento': forms.TextInput(attrs={
                 'class': 'form-control',
                 'placeholder': 'Nome identificativo del documento'
             }),
-            'tipo_documento': forms.Select(attrs={'class': 'form-select'}),
+            'tipo_documento': _SELECT_WIDGET,
             'versione': forms.TextInput(attrs={
                 'class': 'form-control',
                 'placeholder': '1.0'
@@ -481,14 +671,8 @@ class DocStabilimentoForm(forms.ModelForm):
                 'class': 'form-control',
                 'accept': '.pdf,.doc,.docx,.jpg,.jpeg,.png,.dwg'
             }),
-            'data_documento': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'data_scadenza': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
+            'data_documento': _DATE_WIDGET,
+            'data_scadenza': _DATE_WIDGET,
             'note': forms.Textarea(attrs={
                 'class': 'form-control',
                 'rows': 2,
@@ -496,16 +680,42 @@ class DocStabilimentoForm(forms.ModelForm):
             })
         }
     
+    # Layout Crispy statico, costruito una sola volta al caricamento della classe
+    _HELPER = _crea_helper(
+        Layout(
+            Alert(
+                content="Carica un nuovo documento per lo stabilimento.",
+                css_class="alert-info"
+            ),
+            Row(
+                Column('stabilimento', css_class='form-group col-md-6'),
+                Column('tipo_documento', css_class='form-group col-md-6'),
+            ),
+            Row(
+                Column('nome_documento', css_class='form-group col-md-8'),
+                Column('versione', css_class='form-group col-md-4'),
+            ),
+            'descrizione',
+            'file_documento',
+            Row(
+                Column('data_documento', css_class='form-group col-md-6'),
+                Column('data_scadenza', css_class='form-group col-md-6'),
+            ),
+            'note'
+        ),
+        form_enctype='multipart/form-data'
+    )
+    
     def __init__(self, *args, user=None, stabilimento=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = user
         
-        # Configura queryset
-        self.fields['stabilimento'].queryset = Stabilimento.objects.attivi().order_by('nome')
+        # Configura choices
+        self.fields['stabilimento'].choices = [('', '---------')] + stabilimenti_choices()
         
         # Preseleziona stabilimento se specificato
         if stabilimento and not self.instance.pk:
-            self.fields['stabilimento'].initial = stabilimento
+            self.fields['stabilimento'].initial = stabilimento.pk
         
         # Labels
         self.fields['stabilimento'].label = "Stabilimento *"
@@ -523,31 +733,16 @@ class DocStabilimentoForm(forms.ModelForm):
         self.fields['data_documento'].help_text = "Data del documento (se diversa da oggi)"
         self.fields['data_scadenza'].help_text = "Data di scadenza del documento (se applicabile)"
         
-        # Setup Crispy Forms
-        self.helper = FormHelper()
-        self.helper.form_method = 'post'
-        self.helper.form_enctype = 'multipart/form-data'
-        self.helper.layout = Layout(
-            Alert(
-                content="Carica un nuovo documento per lo stabilimento.",
-                css_class="alert-info"
-            ),
-            Row(
-                Column('stabilimento', css_class='form-group col-md-6'),
-                Column('tipo_documento', css_class='form-group col-md-6'),
-            ),
-            Row(
-                Column('nome_documento', css_class='form-group col-md-8'),
-                Column('versione', css_class='form-group col-md-4'),
-            ),
-            'descrizione',
-            'file_documento',
-            Row(
-                Column('data_documento', css_class='form-group col-md-6'),
-                Column('data_scadenza', css_class='form-group col-md-6'),
-            ),
-            'note'
-        )
+        # Setup Crispy Forms (helper condiviso a livello di classe)
+        self.helper = self._HELPER
+    
+    def clean_stabilimento(self):
+        """Converte lo stabilimento scelto nell'istanza del modello"""
+        return _istanza_selezionata(Stabilimento, self.cleaned_data.get('stabilimento'))
+    
+    def clean_file_documento(self):
+        """Validazione dimensione/estensione del documento (ammessi anche i .dwg)"""
+        return _valida_upload(self.cleaned_data.get('file_documento'), _ESTENSIONI_DOCUMENTI)
     
     def clean_data_scadenza(self):
         """Validazione data scadenza"""
@@ -578,11 +773,11 @@ class StabilimentiSearchForm(forms.Form):
         })
     )
     
-    responsabile = forms.ModelChoiceField(
-        queryset=User.objects.filter(is_active=True).order_by('first_name', 'last_name'),
+    responsabile = forms.TypedChoiceField(
+        coerce=int,
+        empty_value=None,
         required=False,
-        empty_label="Tutti i responsabili",
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
     provincia = forms.CharField(
@@ -602,22 +797,12 @@ class StabilimentiSearchForm(forms.Form):
             ('false', 'Solo inattivi')
         ],
         required=False,
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        
-        # Labels
-        self.fields['q'].label = "Cerca"
-        self.fields['responsabile'].label = "Responsabile"
-        self.fields['provincia'].label = "Provincia"
-        self.fields['attivo'].label = "Stato"
-        
-        # Setup Crispy Forms
-        self.helper = FormHelper()
-        self.helper.form_method = 'get'
-        self.helper.layout = Layout(
+    # Layout Crispy statico, costruito una sola volta al caricamento della classe
+    _HELPER = _crea_helper(
+        Layout(
             Row(
                 Column('q', css_class='form-group col-md-4'),
                 Column('responsabile', css_class='form-group col-md-3'),
@@ -628,36 +813,58 @@ class StabilimentiSearchForm(forms.Form):
                     css_class='form-group col-md-1 d-flex align-items-end'
                 ),
             )
-        )
+        ),
+        form_method='get'
+    )
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        
+        # Choices responsabili (il filtro lavora direttamente sul pk)
+        self.fields['responsabile'].choices = [('', 'Tutti i responsabili')] + responsabili_choices()
+        
+        # Labels
+        self.fields['q'].label = "Cerca"
+        self.fields['responsabile'].label = "Responsabile"
+        self.fields['provincia'].label = "Provincia"
+        self.fields['attivo'].label = "Stato"
+        
+        # Setup Crispy Forms (helper condiviso a livello di classe)
+        self.helper = self._HELPER
+
+
+# Choices dei filtri con la voce vuota, calcolate una sola volta
+_CAUSALE_CHOICES = (('', 'Tutte le tipologie'),) + tuple(CostiStabilimento.TipoCosto.choices)
+_STATO_CHOICES = (('', 'Tutti gli stati'),) + tuple(CostiStabilimento.StatoCosto.choices)
 
 
 class CostiSearchForm(forms.Form):
     """Form per ricerca costi stabilimenti"""
     
-    stabilimento = forms.ModelChoiceField(
-        queryset=Stabilimento.objects.attivi().order_by('nome'),
+    stabilimento = forms.TypedChoiceField(
+        coerce=int,
+        empty_value=None,
         required=False,
-        empty_label="Tutti gli stabilimenti",
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
     causale = forms.ChoiceField(
-        choices=[('', 'Tutte le tipologie')] + list(CostiStabilimento.TipoCosto.choices),
+        choices=_CAUSALE_CHOICES,
         required=False,
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
     stato = forms.ChoiceField(
-        choices=[('', 'Tutti gli stati')] + list(CostiStabilimento.StatoCosto.choices),
+        choices=_STATO_CHOICES,
         required=False,
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
-    fornitore = forms.ModelChoiceField(
-        queryset=Fornitore.objects.filter(attivo=True).order_by('nome'),
+    fornitore = forms.TypedChoiceField(
+        coerce=int,
+        empty_value=None,
         required=False,
-        empty_label="Tutti i fornitori",
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
     scadenze_prossime = forms.BooleanField(
@@ -667,31 +874,12 @@ class CostiSearchForm(forms.Form):
     
     anno = forms.ChoiceField(
         required=False,
-        widget=forms.Select(attrs={'class': 'form-select'})
+        widget=_SELECT_WIDGET
     )
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        
-        # Popola anni disponibili
-        anni_disponibili = [('', 'Tutti gli anni')]
-        anno_corrente = timezone.now().year
-        for anno in range(anno_corrente, anno_corrente - 5, -1):
-            anni_disponibili.append((str(anno), str(anno)))
-        self.fields['anno'].choices = anni_disponibili
-        
-        # Labels
-        self.fields['stabilimento'].label = "Stabilimento"
-        self.fields['causale'].label = "Tipologia"
-        self.fields['stato'].label = "Stato"
-        self.fields['fornitore'].label = "Fornitore"
-        self.fields['scadenze_prossime'].label = "Solo scadenze prossime (30 gg)"
-        self.fields['anno'].label = "Anno"
-        
-        # Setup Crispy Forms
-        self.helper = FormHelper()
-        self.helper.form_method = 'get'
-        self.helper.layout = Layout(
+    # Layout Crispy statico, costruito una sola volta al caricamento della classe
+    _HELPER = _crea_helper(
+        Layout(
             Row(
                 Column('stabilimento', css_class='form-group col-md-3'),
                 Column('causale', css_class='form-group col-md-2'),
@@ -706,8 +894,90 @@ class CostiSearchForm(forms.Form):
             Row(
                 Column('scadenze_prossime', css_class='form-group col-md-3'),
             )
-        )
+        ),
+        form_method='get'
+    )
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        
+        # Choices stabilimenti/fornitori (i filtri lavorano direttamente sul pk)
+        self.fields['stabilimento'].choices = [('', 'Tutti gli stabilimenti')] + stabilimenti_choices()
+        self.fields['fornitore'].choices = [('', 'Tutti i fornitori')] + fornitori_choices()
+        
+        # Popola anni disponibili (lista in cache per l'anno corrente)
+        self.fields['anno'].choices = _anni_choices(timezone.localdate().year)
+        
+        # Labels
+        self.fields['stabilimento'].label = "Stabilimento"
+        self.fields['causale'].label = "Tipologia"
+        self.fields['stato'].label = "Stato"
+        self.fields['fornitore'].label = "Fornitore"
+        self.fields['scadenze_prossime'].label = "Solo scadenze prossime (30 gg)"
+        self.fields['anno'].label = "Anno"
         
+        # Setup Crispy Forms (helper condiviso a livello di classe)
+        self.helper = self._HELPER
+        
+# Label, help text e obbligatorietà dei campi adattati alle utenze
+_UTENZA_FIELD_META = MappingProxyType({
+    'consumo_kwh': {
+        'label': "Consumo kWh",
+        'help_text': "Consumo in kWh per energia elettrica",
+        'required': False,
+    },
+    'consumo_mc': {
+        'label': "Consumo mc",
+        'help_text': "Consumo in metri cubi per gas/acqua",
+        'required': False,
+    },
+    'periodo_fatturazione_da': {
+        'label': "Periodo Da",
+        'help_text': "Inizio periodo fatturazione",
+        'required': False,
+    },
+    'periodo_fatturazione_a': {
+        'label': "Periodo A",
+        'help_text': "Fine periodo fatturazione",
+        'required': False,
+    },
+    'codice_pdr_pod': {
+        'label': "Codice PDR/POD",
+        'help_text': "Codice identificativo utenza (PDR per gas, POD per luce)",
+        'required': False,
+    },
+    'titolo': {'label': "Descrizione Bolletta *"},
+    'data_scadenza_servizio': {
+        'label': "Prossima Lettura",
+        'help_text': "Data della prossima lettura o scadenza contratto",
+    },
+    'fattura': {'help_text': "Carica il PDF della bolletta"},
+    'data_richiesta': {'required': False},
+    'data_inizio_lavori': {'required': False},
+    'data_fine_lavori': {'required': False},
+})
+
+
+# Causali ammesse per le utenze
+_UTENZE_CHOICES = (
+    ('', '---------'),
+    ('energia_elettrica', 'Energia Elettrica'),
+    ('gas_naturale', 'Gas Naturale'),
+    ('acqua', 'Acqua e Scarichi'),
+    ('telefonia', 'Telefonia e Internet'),
+    ('rifiuti', 'Smaltimento Rifiuti'),
+)
+_UTENZE_VALIDE = frozenset(valore for valore, _ in _UTENZE_CHOICES if valore)
+
+
+def _crea_campo_utenza(db_field, **kwargs):
+    """
+    formfield_callback di UtenzaForm: costruisce i campi già configurati
+    alla creazione della classe, invece di modificarli a ogni istanza.
+    """
+    return db_field.formfield(**{**kwargs, **_UTENZA_FIELD_META.get(db_field.name, {})})
+
+
 # Sostituisci il UtenzaForm esistente nel file stabilimenti/forms.py con questo:
 
 # In stabilimenti/forms.py, sostituisci UtenzaForm con questa versione:
@@ -717,6 +987,9 @@ class UtenzaForm(CostiStabilimentoForm):
     Form specializzato per utenze - estende CostiStabilimentoForm
     """
     
+    # Campi che save() ricava dalla data fattura anche se non modificati nel form
+    campi_derivati = ('data_richiesta', 'data_inizio_lavori', 'data_fine_lavori')
+    
     class Meta(CostiStabilimentoForm.Meta):
         # Usa la stessa lista di campi di base più i nuovi
         fields = [
@@ -745,10 +1018,17 @@ class UtenzaForm(CostiStabilimentoForm):
             'codice_pdr_pod'
         ]
         
-        # Estendi i widgets ereditando quelli esistenti
-        widgets = {
-            **CostiStabilimentoForm.Meta.widgets,  # Eredita tutti i widget esistenti
-            # Widget per i nuovi campi
+        # Widget per i nuovi campi; quelli esistenti sono ereditati per
+        # riferimento dal form padre (ChainMap, nessuna copia)
+        widgets = ChainMap({
+            'titolo': forms.TextInput(attrs={
+                'class': 'form-control',
+                'placeholder': 'Es: Bolletta Enel Gennaio 2025'
+            }),
+            # Campi nascosti: valorizzati automaticamente in save()
+            'data_richiesta': forms.HiddenInput,
+            'data_inizio_lavori': forms.HiddenInput,
+            'data_fine_lavori': forms.HiddenInput,
             'consumo_kwh': forms.NumberInput(attrs={
                 'class': 'form-control',
                 'step': '0.01',
@@ -761,80 +1041,38 @@ class UtenzaForm(CostiStabilimentoForm):
                 'min': '0',
                 'placeholder': '0.00'
             }),
-            'periodo_fatturazione_da': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
-            'periodo_fatturazione_a': forms.DateInput(attrs={
-                'class': 'form-control',
-                'type': 'date'
-            }),
+            'periodo_fatturazione_da': _DATE_WIDGET,
+            'periodo_fatturazione_a': _DATE_WIDGET,
             'codice_pdr_pod': forms.TextInput(attrs={
                 'class': 'form-control',
                 'placeholder': 'Codice identificativo utenza'
             }),
-        }
+        }, CostiStabilimentoForm.Meta.widgets)
+        
+        # Label/help text/required statici applicati una volta sola
+        formfield_callback = _crea_campo_utenza
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        fields = self.fields
         
-        # NASCONDI IL CAMPO data_richiesta (sarà impostato automaticamente)
-        self.fields['data_richiesta'].widget = forms.HiddenInput()
-        self.fields['data_richiesta'].required = False
-        
-        # Preimposta data_richiesta se non presente
-        if not self.instance.pk and not self.fields['data_richiesta'].initial:
-            self.fields['data_richiesta'].initial = timezone.now().date()
+        # Il form padre imposta in __init__ label e help text generici dei
+        # costi: riapplica quelli specifici delle utenze
+        for nome, meta in _UTENZA_FIELD_META.items():
+            for attributo in ('label', 'help_text'):
+                if attributo in meta:
+                    setattr(fields[nome], attributo, meta[attributo])
         
         # Filtra solo le causali utenze
-        UTENZE_CHOICES = [
-            ('energia_elettrica', 'Energia Elettrica'),
-            ('gas_naturale', 'Gas Naturale'),
-            ('acqua', 'Acqua e Scarichi'),
-            ('telefonia', 'Telefonia e Internet'),
-            ('rifiuti', 'Smaltimento Rifiuti'),
-        ]
-        self.fields['causale'].choices = [('', '---------')] + UTENZE_CHOICES
-        
-        # Labels specifici per utenze
-        self.fields['consumo_kwh'].label = "Consumo kWh"
-        self.fields['consumo_mc'].label = "Consumo mc"
-        self.fields['periodo_fatturazione_da'].label = "Periodo Da"
-        self.fields['periodo_fatturazione_a'].label = "Periodo A"
-        self.fields['codice_pdr_pod'].label = "Codice PDR/POD"
-        
-        # Help text
-        self.fields['consumo_kwh'].help_text = "Consumo in kWh per energia elettrica"
-        self.fields['consumo_mc'].help_text = "Consumo in metri cubi per gas/acqua"
-        self.fields['periodo_fatturazione_da'].help_text = "Inizio periodo fatturazione"
-        self.fields['periodo_fatturazione_a'].help_text = "Fine periodo fatturazione"
-        self.fields['codice_pdr_pod'].help_text = "Codice identificativo utenza (PDR per gas, POD per luce)"
-        
-        # Rendi i nuovi campi non obbligatori
-        self.fields['consumo_kwh'].required = False
-        self.fields['consumo_mc'].required = False
-        self.fields['periodo_fatturazione_da'].required = False
-        self.fields['periodo_fatturazione_a'].required = False
-        self.fields['codice_pdr_pod'].required = False
+        fields['causale'].choices = _UTENZE_CHOICES
         
         # Valori predefiniti per utenze
         if not self.instance.pk:
-            self.fields['stato'].initial = 'fatturato'
-            self.fields['causale'].initial = 'energia_elettrica'
-            self.fields['iva_percentuale'].initial = 22
-        
-        # Modifica alcuni label per adattarli alle utenze
-        self.fields['titolo'].label = "Descrizione Bolletta *"
-        self.fields['titolo'].widget.attrs['placeholder'] = "Es: Bolletta Enel Gennaio 2025"
-        self.fields['data_scadenza_servizio'].label = "Prossima Lettura"
-        self.fields['data_scadenza_servizio'].help_text = "Data della prossima lettura o scadenza contratto"
-        self.fields['fattura'].help_text = "Carica il PDF della bolletta"
-        
-        # Nascondi campi non rilevanti per le utenze
-        self.fields['data_inizio_lavori'].widget = forms.HiddenInput()
-        self.fields['data_inizio_lavori'].required = False
-        self.fields['data_fine_lavori'].widget = forms.HiddenInput()
-        self.fields['data_fine_lavori'].required = False
+            if not fields['data_richiesta'].initial:
+                fields['data_richiesta'].initial = timezone.now().date()
+            fields['stato'].initial = 'fatturato'
+            fields['causale'].initial = 'energia_elettrica'
+            fields['iva_percentuale'].initial = 22
     
     def clean_periodo_fatturazione_a(self):
         """Validazione periodo fatturazione"""
@@ -849,9 +1087,8 @@ class UtenzaForm(CostiStabilimentoForm):
     def clean_causale(self):
         """Assicura che sia selezionata una causale di tipo utenza"""
         causale = self.cleaned_data.get('causale')
-        utenze_valide = ['energia_elettrica', 'gas_naturale', 'acqua', 'telefonia', 'rifiuti']
         
-        if causale and causale not in utenze_valide:
+        if causale and causale not in _UTENZE_VALIDE:
             raise ValidationError("Seleziona un tipo di utenza valido")
         
         return causale
@@ -860,15 +1097,17 @@ class UtenzaForm(CostiStabilimentoForm):
         """Override save per gestire i campi specifici delle utenze"""
         instance = super().save(commit=False)
         
-        # Assicurati che data_richiesta sia impostata
-        if not instance.data_richiesta:
-            instance.data_richiesta = instance.data_fattura or timezone.now().date()
+        data_fattura = instance.data_fattura
+        
+        # Assicurati che data_richiesta sia impostata (la data odierna
+        # viene calcolata solo se manca anche la data fattura)
+        instance.data_richiesta = (
+            instance.data_richiesta or data_fattura or timezone.now().date()
+        )
         
         # Se non ci sono date lavori, impostale uguali alla data fattura
-        if not instance.data_inizio_lavori and instance.data_fattura:
-            instance.data_inizio_lavori = instance.data_fattura
-        if not instance.data_fine_lavori and instance.data_fattura:
-            instance.data_fine_lavori = instance.data_fattura
+        instance.data_inizio_lavori = instance.data_inizio_lavori or data_fattura
+        instance.data_fine_lavori = instance.data_fine_lavori or data_fattura
         
         if commit:
             instance.save()
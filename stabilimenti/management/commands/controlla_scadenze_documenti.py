@@ -1,12 +1,39 @@
-from django.core.management.base import BaseCommand
+import os
+
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from bisect import bisect_left
 from datetime import timedelta
 from stabilimenti.models import DocStabilimento
 from core.models import Promemoria
 
 User = get_user_model()
 
+# Il modello utente del progetto ha il campo livello? (calcolato una sola volta)
+HA_LIVELLO = any(f.name == 'livello' for f in User._meta.get_fields())
+
+# Documenti letti e promemoria inseriti per blocco (default di --batch-size)
+BULK_BATCH_SIZE = int(os.environ.get('PROMEMORIA_BULK_BATCH', 500))
+
+# Priorità dei promemoria risolte una sola volta all'import
+PRIORITA_ALTA = Promemoria.Priorita.ALTA
+PRIORITA_MEDIA = Promemoria.Priorita.MEDIA
+PRIORITA_BASSA = Promemoria.Priorita.BASSA
+
+URGENZA = {
+    PRIORITA_ALTA: "URGENTE",
+    PRIORITA_MEDIA: "ATTENZIONE",
+    PRIORITA_BASSA: "PROGRAMMATO",
+}
+
+# Limiti superiori (inclusi) dei giorni rimanenti per fascia di priorità
+LIMITI_GIORNI = (7, 15)
+PRIORITA_PER_FASCIA = (PRIORITA_ALTA, PRIORITA_MEDIA, PRIORITA_BASSA)
+
 
 class Command(BaseCommand):
     help = 'Controlla documenti in scadenza nei prossimi 30 giorni e crea promemoria automatici'
@@ -23,10 +50,21 @@ class Command(BaseCommand):
             action='store_true',
             help='Esegue il controllo senza creare promemoria'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BULK_BATCH_SIZE,
+            help=f'Documenti letti e promemoria inseriti per blocco (default: {BULK_BATCH_SIZE})'
+        )
 
     def handle(self, *args, **options):
         giorni_anticipo = options['giorni']
         dry_run = options['dry_run']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size deve essere maggiore di zero')
+        # Il dettaglio per documento/destinatario solo con -v 2 o superiore
+        self.dettaglio = options['verbosity'] >= 2
         
         oggi = timezone.now().date()
         data_limite = oggi + timedelta(days=giorni_anticipo)
@@ -37,14 +75,36 @@ class Command(BaseCommand):
             )
         )
         
-        # Trova documenti in scadenza
+        # Trova amministratori e contabili: senza destinatari non serve
+        # nemmeno interrogare i documenti
+        destinatari = self._get_destinatari_promemoria()
+        
+        if not destinatari:
+            self.stdout.write(
+                self.style.ERROR(
+                    'Nessun amministratore o contabile trovato per i promemoria!'
+                )
+            )
+            return
+        
+        # Trova documenti in scadenza (solo le colonne usate per log e promemoria);
+        # il queryset viene letto a blocchi, senza tenere in memoria tutte le righe
         documenti_in_scadenza = DocStabilimento.objects.filter(
             data_scadenza__gte=oggi,
             data_scadenza__lte=data_limite,
             attivo=True
-        ).select_related('stabilimento', 'caricato_da').order_by('data_scadenza')
+        ).select_related('stabilimento', 'caricato_da').only(
+            'nome_documento',
+            'tipo_documento',
+            'data_scadenza',
+            'stabilimento__nome',
+            'caricato_da__username',
+            'caricato_da__first_name',
+            'caricato_da__last_name',
+        ).order_by('data_scadenza')
+        totale_documenti = documenti_in_scadenza.count()
         
-        if not documenti_in_scadenza:
+        if not totale_documenti:
             self.stdout.write(
                 self.style.SUCCESS('Nessun documento in scadenza trovato.')
             )
@@ -52,29 +112,18 @@ class Command(BaseCommand):
         
         self.stdout.write(
             self.style.WARNING(
-                f'Trovati {documenti_in_scadenza.count()} documenti in scadenza:'
+                f'Trovati {totale_documenti} documenti in scadenza:'
             )
         )
         
-        # Lista documenti per debugging
-        for doc in documenti_in_scadenza:
-            giorni_rimanenti = (doc.data_scadenza - oggi).days
-            self.stdout.write(
+        # Lista documenti per debugging, scritta in un'unica write
+        if self.dettaglio:
+            self.stdout.write('\n'.join(
                 f'  - {doc.nome_documento} ({doc.stabilimento.nome}) - '
                 f'Scade il {doc.data_scadenza.strftime("%d/%m/%Y")} '
-                f'({giorni_rimanenti} giorni)'
-            )
-        
-        # Trova amministratori e contabili
-        destinatari = self._get_destinatari_promemoria()
-        
-        if not destinatari:
-            self.stdout.write(
-                self.style.ERROR(
-                    'Nessun amministratore o contabile trovato per i promemoria!'
-                )
-            )
-            return
+                f'({(doc.data_scadenza - oggi).days} giorni)'
+                for doc in documenti_in_scadenza.iterator(chunk_size=batch_size)
+            ))
         
         self.stdout.write(
             f'Destinatari promemoria: {", ".join([u.username for u in destinatari])}'
@@ -86,109 +135,161 @@ class Command(BaseCommand):
             )
             return
         
-        # Crea promemoria
-        promemoria_creati = self._crea_promemoria(documenti_in_scadenza, destinatari, giorni_anticipo)
+        # Crea promemoria: controllo dei duplicati e inserimento in un'unica transazione
+        with transaction.atomic():
+            promemoria_creati = self._crea_promemoria(
+                documenti_in_scadenza, destinatari, giorni_anticipo, batch_size
+            )
         
         self.stdout.write(
             self.style.SUCCESS(
-                f'Creati {promemoria_creati} promemoria per {documenti_in_scadenza.count()} documenti.'
+                f'Creati {promemoria_creati} promemoria per {totale_documenti} documenti.'
             )
         )
 
     def _get_destinatari_promemoria(self):
         """Trova utenti amministratori e contabili per i promemoria"""
-        destinatari = []
-        
-        # Cerca per attributo livello se presente
-        if hasattr(User, 'livello'):
-            destinatari.extend(
-                User.objects.filter(
-                    livello__in=['amministratore', 'contabile'],
-                    is_active=True
-                )
-            )
+        livelli = ['amministratore', 'contabile']
         
-        # Fallback: cerca staff e superuser
-        if not destinatari:
-            destinatari.extend(
-                User.objects.filter(
-                    is_staff=True,
-                    is_active=True
-                )
-            )
+        # Cerca per campo livello se presente
+        if not HA_LIVELLO:
+            return list(User.objects.filter(is_staff=True, is_active=True).order_by('username'))
         
-        return list(set(destinatari))  # Rimuovi duplicati
+        # Una sola query per amministratori/contabili e staff (fallback)
+        candidati = list(
+            User.objects.filter(
+                Q(livello__in=livelli) | Q(is_staff=True),
+                is_active=True
+            ).order_by('username')
+        )
+        destinatari = [u for u in candidati if u.livello in livelli]
+        
+        # Fallback: staff e superuser solo se non ci sono amministratori/contabili
+        return destinatari or candidati
 
-    def _crea_promemoria(self, documenti, destinatari, giorni_anticipo):
+    def _crea_promemoria(self, documenti, destinatari, giorni_anticipo, batch_size=BULK_BATCH_SIZE):
         """Crea promemoria automatici per i documenti in scadenza"""
         
+        # Descrizioni e query vengono preparate solo se c'è qualcuno da avvisare
+        # (il dry-run esce prima di arrivare qui)
+        if not destinatari:
+            return 0
+        
         oggi = timezone.now().date()
+        generato_il = oggi.strftime('%d/%m/%Y')
+        nuovi_promemoria = []
         promemoria_creati = 0
+        righe_log = []
         
-        # Crea un promemoria per ogni documento e destinatario
-        for doc in documenti:
+        # Documenti per cui almeno un destinatario non ha ancora un promemoria
+        # aperto per la scadenza attuale: il confronto avviene nel database,
+        # così nelle esecuzioni successive i documenti già notificati non
+        # arrivano nemmeno in Python. Un documento rinnovato con una nuova
+        # scadenza riceve nuovi promemoria anche se quelli vecchi sono aperti
+        promemoria_aperti = Promemoria.objects.filter(
+            documento=OuterRef('pk'),
+            data_scadenza=OuterRef('data_scadenza'),
+            assegnato_a__in=destinatari,
+            completato=False
+        ).order_by().values('documento').annotate(
+            totale=Count('assegnato_a', distinct=True)
+        ).values('totale')
+        da_notificare = documenti.annotate(
+            destinatari_notificati=Coalesce(Subquery(promemoria_aperti), 0)
+        ).filter(
+            destinatari_notificati__lt=len(destinatari)
+        )
+        
+        if self.dettaglio:
+            righe_log.extend(
+                f'  ⚠ Promemoria già esistenti per tutti i destinatari: {nome}'
+                for nome in documenti.exclude(
+                    pk__in=da_notificare.values('pk')
+                ).values_list('nome_documento', flat=True)
+            )
+        
+        # Terne (destinatario, documento, scadenza) già coperte da un promemoria
+        # aperto, lette con una sola query sulla FK indicizzata
+        esistenti = set(Promemoria.objects.filter(
+            documento__in=da_notificare.values('pk'),
+            assegnato_a__in=destinatari,
+            completato=False
+        ).values_list('assegnato_a_id', 'documento_id', 'data_scadenza'))
+        
+        # Un amministratore come creatore (può essere il sistema)
+        creatore = destinatari[0]
+        
+        # Crea un promemoria per ogni documento e destinatario, leggendo i
+        # documenti a blocchi e inserendo i promemoria a ogni blocco pieno
+        for doc in da_notificare.iterator(chunk_size=batch_size):
             giorni_rimanenti = (doc.data_scadenza - oggi).days
             
             # Determina la priorità in base ai giorni rimanenti
-            if giorni_rimanenti <= 7:
-                priorita = Promemoria.Priorita.ALTA
-                urgenza_text = "URGENTE"
-            elif giorni_rimanenti <= 15:
-                priorita = Promemoria.Priorita.MEDIA
-                urgenza_text = "ATTENZIONE"
-            else:
-                priorita = Promemoria.Priorita.BASSA
-                urgenza_text = "PROGRAMMATO"
+            priorita = PRIORITA_PER_FASCIA[bisect_left(LIMITI_GIORNI, giorni_rimanenti)]
+            urgenza_text = URGENZA[priorita]
             
             # Titolo del promemoria
             titolo = f"{urgenza_text}: {doc.nome_documento} in scadenza"
             
-            # Descrizione dettagliata
-            descrizione = f"""DOCUMENTO IN SCADENZA - {doc.stabilimento.nome}
+            # Valori del documento letti una sola volta
+            stabilimento_nome = doc.stabilimento.nome
+            tipo_documento = doc.get_tipo_documento_display()
+            data_scadenza = doc.data_scadenza.strftime('%d/%m/%Y')
+            caricato_da = doc.caricato_da.get_full_name() or doc.caricato_da.username
+            
+            # Descrizione dettagliata (condivisa da tutti i destinatari)
+            descrizione = f"""DOCUMENTO IN SCADENZA - {stabilimento_nome}
 
 📄 Documento: {doc.nome_documento}
-🏢 Stabilimento: {doc.stabilimento.nome}
-📋 Tipo: {doc.get_tipo_documento_display()}
-📅 Data scadenza: {doc.data_scadenza.strftime('%d/%m/%Y')}
+🏢 Stabilimento: {stabilimento_nome}
+📋 Tipo: {tipo_documento}
+📅 Data scadenza: {data_scadenza}
 ⏰ Giorni rimanenti: {giorni_rimanenti}
-👤 Caricato da: {doc.caricato_da.get_full_name() or doc.caricato_da.username}
+👤 Caricato da: {caricato_da}
 
 Si prega di rinnovare il documento quanto prima per evitare problemi di conformità.
 
-Generato automaticamente il {oggi.strftime('%d/%m/%Y')}"""
+Generato automaticamente il {generato_il}"""
             
-            # Crea promemoria per ogni destinatario
-            for destinatario in destinatari:
-                
-                # Controlla se esiste già un promemoria simile non completato
-                promemoria_esistente = Promemoria.objects.filter(
-                    titolo__icontains=doc.nome_documento,
+            # Destinatari senza un promemoria non completato per il documento
+            mancanti = [
+                d for d in destinatari if (d.pk, doc.pk, doc.data_scadenza) not in esistenti
+            ]
+            
+            # Crea i promemoria del documento in un colpo solo
+            nuovi_promemoria.extend(
+                Promemoria(
+                    titolo=titolo,
+                    descrizione=descrizione,
+                    data_scadenza=doc.data_scadenza,
+                    priorita=priorita,
+                    creato_da=creatore,
                     assegnato_a=destinatario,
-                    completato=False,
-                    data_scadenza=doc.data_scadenza
-                ).first()
-                
-                if not promemoria_esistente:
-                    # Trova un utente amministratore come creatore (può essere il sistema)
-                    creatore = destinatari[0] if destinatari else destinatario
-                    
-                    promemoria = Promemoria.objects.create(
-                        titolo=titolo,
-                        descrizione=descrizione,
-                        data_scadenza=doc.data_scadenza,
-                        priorita=priorita,
-                        creato_da=creatore,
-                        assegnato_a=destinatario
-                    )
-                    
-                    promemoria_creati += 1
-                    
-                    self.stdout.write(
-                        f'  → Promemoria creato per {destinatario.username}: {titolo}'
-                    )
-                else:
-                    self.stdout.write(
-                        f'  ⚠ Promemoria già esistente per {destinatario.username}: {doc.nome_documento}'
-                    )
+                    documento=doc
+                )
+                for destinatario in mancanti
+            )
+            if len(nuovi_promemoria) >= batch_size:
+                promemoria_creati += len(
+                    Promemoria.objects.bulk_create(nuovi_promemoria, batch_size=batch_size)
+                )
+                nuovi_promemoria = []
+            
+            if self.dettaglio:
+                righe_log.extend(
+                    f'  → Promemoria creato per {d.username}: {titolo}' for d in mancanti
+                )
+                righe_log.extend(
+                    f'  ⚠ Promemoria già esistente per {d.username}: {doc.nome_documento}'
+                    for d in destinatari if (d.pk, doc.pk, doc.data_scadenza) in esistenti
+                )
+        
+        if righe_log:
+            self.stdout.write('\n'.join(righe_log))
+        
+        # Inserisce l'ultimo blocco di promemoria
+        promemoria_creati += len(
+            Promemoria.objects.bulk_create(nuovi_promemoria, batch_size=batch_size)
+        )
         
         return promemoria_creati
\ No newline at end of file
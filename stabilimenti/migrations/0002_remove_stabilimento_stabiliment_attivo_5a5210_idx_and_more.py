@@ -0,0 +1,23 @@
+# Generated by Django 4.2.21 on 2026-10-16 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_attivo_5a5210_idx",
+        ),
+        migrations.AddIndex(
+            model_name="stabilimento",
+            index=models.Index(
+                fields=["attivo", "nome", "id"], name="stabiliment_attivo_70df40_idx"
+            ),
+        ),
+    ]
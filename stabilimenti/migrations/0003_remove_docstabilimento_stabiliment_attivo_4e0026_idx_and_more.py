@@ -0,0 +1,23 @@
+# Generated by Django 4.2.21 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0002_remove_stabilimento_stabiliment_attivo_5a5210_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="docstabilimento",
+            name="stabiliment_attivo_4e0026_idx",
+        ),
+        migrations.AddIndex(
+            model_name="docstabilimento",
+            index=models.Index(
+                fields=["attivo", "data_scadenza"], name="stabiliment_attivo_60528d_idx"
+            ),
+        ),
+    ]
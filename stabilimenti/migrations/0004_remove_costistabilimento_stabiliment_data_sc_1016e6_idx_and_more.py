@@ -0,0 +1,25 @@
+# Generated by Django 4.2.21 on 2026-10-16 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0003_remove_docstabilimento_stabiliment_attivo_4e0026_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="costistabilimento",
+            name="stabiliment_data_sc_1016e6_idx",
+        ),
+        migrations.AddIndex(
+            model_name="costistabilimento",
+            index=models.Index(
+                condition=models.Q(("data_scadenza_servizio__isnull", False)),
+                fields=["data_scadenza_servizio", "stabilimento"],
+                name="costi_scad_stab_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.21 on 2026-10-16 12:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0004_remove_costistabilimento_stabiliment_data_sc_1016e6_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="costistabilimento",
+            name="stabiliment_numero__613300_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_codice__3450ae_idx",
+        ),
+    ]
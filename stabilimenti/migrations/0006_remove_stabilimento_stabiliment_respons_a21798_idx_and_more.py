@@ -0,0 +1,35 @@
+# Generated by Django 4.2.21 on 2026-10-16 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0005_remove_costistabilimento_stabiliment_numero__613300_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_respons_a21798_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_respons_239e66_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_citta_acf5f6_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="stabilimento",
+            name="stabiliment_attivo_70df40_idx",
+        ),
+        migrations.AddIndex(
+            model_name="stabilimento",
+            index=models.Index(
+                condition=models.Q(("attivo", True)), fields=["nome"], name="stab_attivi_by_nome"
+            ),
+        ),
+    ]
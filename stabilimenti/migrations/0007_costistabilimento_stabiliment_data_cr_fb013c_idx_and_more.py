@@ -0,0 +1,26 @@
+# Generated by Django 4.2.21 on 2026-10-16 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0006_remove_stabilimento_stabiliment_respons_a21798_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="costistabilimento",
+            index=models.Index(
+                fields=["-data_creazione"], name="stabiliment_data_cr_fb013c_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="costistabilimento",
+            index=models.Index(
+                fields=["stabilimento", "-data_creazione"],
+                name="stabiliment_stabili_77264b_idx",
+            ),
+        ),
+    ]
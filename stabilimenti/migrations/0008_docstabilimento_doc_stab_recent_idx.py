@@ -0,0 +1,19 @@
+# Generated by Django 4.2.21 on 2026-10-16 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0007_costistabilimento_stabiliment_data_cr_fb013c_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="docstabilimento",
+            index=models.Index(
+                fields=["stabilimento", "-data_inserimento"], name="doc_stab_recent_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.21 on 2026-10-16 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stabilimenti", "0008_docstabilimento_doc_stab_recent_idx"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="costistabilimento",
+            name="stabiliment_stabili_4d2eee_idx",
+        ),
+        migrations.AddIndex(
+            model_name="costistabilimento",
+            index=models.Index(
+                fields=["causale", "data_fattura"],
+                name="stabiliment_causale_ac01ed_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="costistabilimento",
+            index=models.Index(
+                fields=["stabilimento", "causale", "data_fattura"],
+                name="stabiliment_stabili_9e8d25_idx",
+            ),
+        ),
+    ]
@@ -1,4 +1,7 @@
-from django.db import models
+import re
+
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Cast, Coalesce, Substr
 from django.conf import settings
 from django.core.validators import MinValueValidator, RegexValidator
 from django.utils import timezone
@@ -6,7 +9,106 @@ from decimal import Decimal
 from datetime import date
 
 
-class StabilimentoManager(models.Manager):
+def _oggi():
+    """Data odierna nel fuso locale (senza costruire un datetime completo)"""
+    return timezone.localdate()
+
+
+# Validatori condivisi, istanziati una sola volta all'import
+_CAP_VALIDATOR = RegexValidator(
+    regex=r'^\d{5}$',
+    message='Il CAP deve essere di 5 cifre'
+)
+_PROV_VALIDATOR = RegexValidator(
+    regex=r'^[A-Z]{2}$',
+    message='Provincia deve essere di 2 lettere maiuscole'
+)
+
+# Tentativi di salvataggio se un codice generato è già stato usato
+# da un inserimento concorrente
+TENTATIVI_CODICE = 3
+
+
+def _progressivo_successivo(queryset, campo, prefisso):
+    """
+    Progressivo successivo al numero più alto dei codici "<prefisso><numero>".
+    Il massimo è calcolato sulla parte numerica convertita in intero, non
+    sull'ordinamento del testo: con il padding a larghezza fissa 'STB999'
+    verrebbe dopo 'STB1000'. I codici eliminati non causano duplicati.
+    """
+    ultimo = queryset.filter(**{
+        f'{campo}__startswith': prefisso,
+        f'{campo}__regex': rf'^{re.escape(prefisso)}[0-9]+$',
+    }).aggregate(
+        ultimo=models.Max(Cast(Substr(campo, len(prefisso) + 1), models.IntegerField()))
+    )['ultimo']
+    return ultimo + 1 if ultimo else 1
+
+
+def _salva_con_codice(istanza, campo, genera, salva):
+    """
+    Genera il codice e salva; se un inserimento concorrente ha appena usato
+    lo stesso codice (vincolo unique) lo rigenera e riprova.
+    """
+    for tentativo in range(TENTATIVI_CODICE):
+        setattr(istanza, campo, genera())
+        try:
+            with transaction.atomic():
+                return salva()
+        except IntegrityError:
+            if tentativo == TENTATIVI_CODICE - 1:
+                raise
+
+
+class StabilimentoQuerySet(models.QuerySet):
+    """QuerySet per gli stabilimenti (filtri e annotazioni concatenabili)"""
+    
+    def con_scadenze_prossime(self, giorni=30, *, oggi=None):
+        """Stabilimenti con scadenze nei prossimi X giorni"""
+        oggi = oggi or _oggi()
+        return self.filter(
+            costi__data_scadenza_servizio__lte=oggi + timezone.timedelta(days=giorni),
+            costi__data_scadenza_servizio__gte=oggi
+        ).distinct()
+    
+    def with_dashboard_stats(self, *, oggi=None):
+        """
+        Costi dell'anno corrente (costi_anno) e scadenze nei prossimi 7 giorni
+        (scadenze_urgenti) calcolati con una sola JOIN + GROUP BY, al posto di
+        get_costi_anno_corrente() / has_scadenze_urgenti() per ogni riga
+        """
+        oggi = oggi or _oggi()
+        return self.annotate(
+            costi_anno=models.Sum(
+                'costi__importo',
+                filter=models.Q(costi__data_fattura__year=oggi.year),
+                default=Decimal('0.00')
+            ),
+            scadenze_urgenti=models.Count(
+                'costi',
+                filter=models.Q(
+                    costi__data_scadenza_servizio__gte=oggi,
+                    costi__data_scadenza_servizio__lte=oggi + timezone.timedelta(days=7)
+                )
+            )
+        )
+    
+    def with_prossima_scadenza(self, *, oggi=None):
+        """
+        Prima scadenza futura tra i documenti attivi (prossima_scadenza),
+        calcolata con una subquery per riga al posto di una query per
+        stabilimento
+        """
+        oggi = oggi or _oggi()
+        documenti = DocStabilimento.objects.filter(
+            stabilimento=models.OuterRef('pk'),
+            data_scadenza__gte=oggi,
+            attivo=True
+        ).order_by('data_scadenza').values('data_scadenza')[:1]
+        return self.annotate(prossima_scadenza=models.Subquery(documenti))
+
+
+class StabilimentoManager(models.Manager.from_queryset(StabilimentoQuerySet)):
     """Manager personalizzato per gli stabilimenti"""
     
     def attivi(self):
@@ -16,14 +118,6 @@ class StabilimentoManager(models.Manager):
     def per_responsabile(self, responsabile):
         """Stabilimenti gestiti da un responsabile"""
         return self.filter(responsabile=responsabile)
-    
-    def con_scadenze_prossime(self, giorni=30):
-        """Stabilimenti con scadenze nei prossimi X giorni"""
-        data_limite = timezone.now().date() + timezone.timedelta(days=giorni)
-        return self.filter(
-            costi__data_scadenza_servizio__lte=data_limite,
-            costi__data_scadenza_servizio__gte=timezone.now().date()
-        ).distinct()
 
 
 class Stabilimento(models.Model):
@@ -52,18 +146,12 @@ class Stabilimento(models.Model):
     indirizzo = models.CharField(max_length=300)
     cap = models.CharField(
         max_length=5,
-        validators=[RegexValidator(
-            regex=r'^\d{5}$',
-            message='Il CAP deve essere di 5 cifre'
-        )]
+        validators=[_CAP_VALIDATOR]
     )
     citta = models.CharField(max_length=100)
     provincia = models.CharField(
         max_length=2,
-        validators=[RegexValidator(
-            regex=r'^[A-Z]{2}$',
-            message='Provincia deve essere di 2 lettere maiuscole'
-        )]
+        validators=[_PROV_VALIDATOR]
     )
     
     # === CONTATTI ===
@@ -164,72 +252,82 @@ class Stabilimento(models.Model):
         verbose_name_plural = "Stabilimenti"
         ordering = ['nome']
         indexes = [
-            models.Index(fields=['attivo']),
-            models.Index(fields=['codice_stabilimento']),
-            models.Index(fields=['responsabile_operativo']),
-            models.Index(fields=['responsabile_amministrativo']),
-            models.Index(fields=['citta']),
+            # Elenco degli attivi ordinato per nome (attivi().order_by('nome'),
+            # select dei form); le FK dei responsabili hanno già l'indice di Django
+            models.Index(
+                fields=['nome'],
+                name='stab_attivi_by_nome',
+                condition=models.Q(attivo=True),
+            ),
         ]
     
     def __str__(self):
         return f"{self.codice_stabilimento} - {self.nome}"
     
     def save(self, *args, **kwargs):
-        # Genera codice automatico se non presente
-        if not self.codice_stabilimento:
-            self.codice_stabilimento = self._genera_codice()
-        
         # NOTA: creato_da e modificato_da vanno gestiti nella view
         # perché il model non ha accesso al request.user
+        
+        # Genera codice automatico se non presente
+        if not self.codice_stabilimento:
+            return _salva_con_codice(
+                self, 'codice_stabilimento', self._genera_codice,
+                lambda: super(Stabilimento, self).save(*args, **kwargs)
+            )
         super().save(*args, **kwargs)
     
     def _genera_codice(self):
         """Genera codice stabilimento univoco"""
-        ultimo_numero = Stabilimento.objects.filter(
-            codice_stabilimento__startswith='STB'
-        ).count()
-        return f"STB{(ultimo_numero + 1):03d}"
+        numero = _progressivo_successivo(
+            Stabilimento.objects.all(), 'codice_stabilimento', 'STB'
+        )
+        return f"STB{numero:03d}"
     
     # === METODI INFORMATIVI ===
     def get_indirizzo_completo(self):
         """Restituisce l'indirizzo completo formattato"""
         return f"{self.indirizzo}, {self.cap} {self.citta} ({self.provincia})"
     
-    def get_costi_anno_corrente(self):
+    def get_costi_anno_corrente(self, *, oggi=None):
         """Costi sostenuti nell'anno corrente"""
-        anno_corrente = timezone.now().year
+        anno_corrente = (oggi or _oggi()).year
         return self.costi.filter(
             data_fattura__year=anno_corrente
         ).aggregate(
-            totale=models.Sum('importo')
-        )['totale'] or Decimal('0.00')
+            totale=Coalesce(models.Sum('importo'), models.Value(Decimal('0.00')))
+        )['totale']
     
-    def get_prossime_scadenze(self, giorni=30):
-        """Scadenze nei prossimi X giorni"""
-        data_limite = timezone.now().date() + timezone.timedelta(days=giorni)
+    def _scadenze_qs(self, giorni=30, *, oggi=None):
+        """Costi in scadenza nei prossimi X giorni, senza ordinamento"""
+        oggi = oggi or _oggi()
         return self.costi.filter(
-            data_scadenza_servizio__lte=data_limite,
-            data_scadenza_servizio__gte=timezone.now().date()
-        ).order_by('data_scadenza_servizio')
+            data_scadenza_servizio__lte=oggi + timezone.timedelta(days=giorni),
+            data_scadenza_servizio__gte=oggi
+        )
     
-    def has_scadenze_urgenti(self, giorni=7):
+    def get_prossime_scadenze(self, giorni=30, *, oggi=None):
+        """Scadenze nei prossimi X giorni"""
+        return self._scadenze_qs(giorni, oggi=oggi).order_by('data_scadenza_servizio')
+    
+    def has_scadenze_urgenti(self, giorni=7, *, oggi=None):
         """Verifica se ci sono scadenze urgenti"""
-        return self.get_prossime_scadenze(giorni).exists()
+        # Per l'EXISTS basta il filtro: l'ordinamento servirebbe solo a video
+        return self._scadenze_qs(giorni, oggi=oggi).exists()
 
 
-class CostiStabilimentoManager(models.Manager):
-    """Manager per i costi di stabilimento"""
+class CostiStabilimentoQuerySet(models.QuerySet):
+    """QuerySet per i costi di stabilimento (filtri concatenabili)"""
     
     def per_tipo(self, tipo_costo):
         """Filtra per tipo di costo"""
         return self.filter(causale=tipo_costo)
     
-    def scadenze_prossime(self, giorni=30):
+    def scadenze_prossime(self, giorni=30, *, oggi=None):
         """Costi con scadenze nei prossimi X giorni"""
-        data_limite = timezone.now().date() + timezone.timedelta(days=giorni)
+        oggi = oggi or _oggi()
         return self.filter(
-            data_scadenza_servizio__lte=data_limite,
-            data_scadenza_servizio__gte=timezone.now().date()
+            data_scadenza_servizio__lte=oggi + timezone.timedelta(days=giorni),
+            data_scadenza_servizio__gte=oggi
         )
     
     def dell_anno(self, anno):
@@ -243,6 +341,61 @@ class CostiStabilimentoManager(models.Manager):
             data_fattura__lte=data_fine
         )
     
+    def with_totals(self):
+        """
+        IVA e totale ivato calcolati dal database (iva_calcolata, totale_con_iva),
+        al posto di calcola_iva() / calcola_totale_con_iva() riga per riga
+        """
+        return self.annotate(
+            iva_calcolata=models.ExpressionWrapper(
+                models.F('importo') * models.F('iva_percentuale') / Decimal('100'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2)
+            )
+        ).annotate(
+            totale_con_iva=models.ExpressionWrapper(
+                models.F('importo') + models.F('iva_calcolata'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2)
+            )
+        )
+    
+    def with_scadenza_bucket(self, *, oggi=None):
+        """
+        Fascia di scadenza calcolata dal database (scadenza_bucket):
+        'scaduto', 'urgente' (entro 7 giorni), 'prossima' (entro 30 giorni),
+        'futura' oltre i 30 giorni, None senza data di scadenza
+        """
+        oggi = oggi or _oggi()
+        return self.annotate(
+            scadenza_bucket=models.Case(
+                models.When(data_scadenza_servizio__lt=oggi, then=models.Value('scaduto')),
+                models.When(
+                    data_scadenza_servizio__lte=oggi + timezone.timedelta(days=7),
+                    then=models.Value('urgente')
+                ),
+                models.When(
+                    data_scadenza_servizio__lte=oggi + timezone.timedelta(days=30),
+                    then=models.Value('prossima')
+                ),
+                models.When(data_scadenza_servizio__isnull=False, then=models.Value('futura')),
+                default=None,
+                output_field=models.CharField()
+            )
+        )
+
+
+class CostiStabilimentoManager(models.Manager.from_queryset(CostiStabilimentoQuerySet)):
+    """Manager per i costi di stabilimento"""
+    
+    def get_queryset(self):
+        """Stabilimento, fornitore e incaricato in JOIN (usati da __str__ e liste)"""
+        # Le relazioni inverse (stabilimento.costi) usano già questo manager.
+        # Non va impostato come base_manager_name: refresh_from_db() dei campi
+        # differiti (.only() in costi_list) applica .only() al base manager e
+        # fallirebbe con select_related su relazioni non caricate
+        return super().get_queryset().select_related(
+            'stabilimento', 'fornitore', 'incaricato'
+        )
+
 
 class CostiStabilimento(models.Model):
     """
@@ -437,12 +590,23 @@ class CostiStabilimento(models.Model):
         verbose_name_plural = "Costi Stabilimenti"
         ordering = ['-data_creazione']
         indexes = [
-            models.Index(fields=['stabilimento', 'causale']),
-            models.Index(fields=['data_scadenza_servizio']),
+            # Utenze dell'anno per tipo (dashboard e ricerca utenze) e dello
+            # stabilimento per tipo: data_fattura__year diventa già un BETWEEN
+            models.Index(fields=['causale', 'data_fattura']),
+            models.Index(fields=['stabilimento', 'causale', 'data_fattura']),
+            # Intervalli di scadenza (dashboard e scadenze_prossime) già uniti
+            # allo stabilimento; solo le righe che hanno una scadenza
+            models.Index(
+                fields=['data_scadenza_servizio', 'stabilimento'],
+                name='costi_scad_stab_idx',
+                condition=models.Q(data_scadenza_servizio__isnull=False),
+            ),
             models.Index(fields=['stato']),
             models.Index(fields=['fornitore']),
             models.Index(fields=['data_fattura']),
-            models.Index(fields=['numero_pratica']),
+            # Lista costi (anche per stabilimento) già nell'ordine di pagina
+            models.Index(fields=['-data_creazione']),
+            models.Index(fields=['stabilimento', '-data_creazione']),
         ]
     
     def __str__(self):
@@ -451,16 +615,41 @@ class CostiStabilimento(models.Model):
     def save(self, *args, **kwargs):
         # Genera numero pratica se nuovo
         if not self.numero_pratica:
-            self.numero_pratica = self._genera_numero_pratica()
+            return _salva_con_codice(
+                self, 'numero_pratica', self._genera_numero_pratica,
+                lambda: super(CostiStabilimento, self).save(*args, **kwargs)
+            )
         super().save(*args, **kwargs)
     
     def _genera_numero_pratica(self):
         """Genera numero pratica univoco"""
         anno = timezone.now().year
-        ultimo_numero = CostiStabilimento.objects.filter(
-            numero_pratica__startswith=f"STB-{anno}-"
-        ).count()
-        return f"STB-{anno}-{(ultimo_numero + 1):04d}"
+        numero = _progressivo_successivo(
+            CostiStabilimento.objects.all(), 'numero_pratica', f"STB-{anno}-"
+        )
+        return f"STB-{anno}-{numero:04d}"
+    
+    @classmethod
+    def assign_numero_pratica_batch(cls, costi):
+        """
+        Assegna i numeri pratica a più costi nuovi leggendo l'ultimo numero
+        una sola volta, così possono essere inseriti con bulk_create (che non
+        chiama save()):
+        
+            CostiStabilimento.objects.bulk_create(
+                CostiStabilimento.assign_numero_pratica_batch(costi), batch_size=500
+            )
+        
+        Da eseguire nella stessa transazione del bulk_create.
+        """
+        anno = timezone.now().year
+        prefisso = f"STB-{anno}-"
+        numero = _progressivo_successivo(cls.objects.all(), 'numero_pratica', prefisso)
+        for costo in costi:
+            if not costo.numero_pratica:
+                costo.numero_pratica = f"{prefisso}{numero:04d}"
+                numero += 1
+        return costi
     
     # === METODI DI CALCOLO ===
     def calcola_totale_con_iva(self):
@@ -472,22 +661,22 @@ class CostiStabilimento(models.Model):
         return self.importo * (self.iva_percentuale / Decimal('100'))
     
     # === METODI INFORMATIVI ===
-    def is_scaduto(self):
+    def is_scaduto(self, oggi=None):
         """Verifica se il servizio è scaduto"""
         if self.data_scadenza_servizio:
-            return self.data_scadenza_servizio < timezone.now().date()
+            return self.data_scadenza_servizio < (oggi or _oggi())
         return False
     
-    def giorni_alla_scadenza(self):
+    def giorni_alla_scadenza(self, oggi=None):
         """Restituisce i giorni rimanenti alla scadenza"""
         if self.data_scadenza_servizio:
-            delta = self.data_scadenza_servizio - timezone.now().date()
+            delta = self.data_scadenza_servizio - (oggi or _oggi())
             return delta.days
         return None
     
-    def is_in_scadenza(self, giorni=30):
+    def is_in_scadenza(self, giorni=30, oggi=None):
         """Verifica se il servizio è in scadenza nei prossimi X giorni"""
-        giorni_rimasti = self.giorni_alla_scadenza()
+        giorni_rimasti = self.giorni_alla_scadenza(oggi)
         if giorni_rimasti is not None:
             return 0 <= giorni_rimasti <= giorni
         return False
@@ -522,6 +711,14 @@ class CostiStabilimento(models.Model):
         """Verifica se la scadenza è nei prossimi 15 giorni"""
         return self.is_in_scadenza(15)
 
+class DocStabilimentoManager(models.Manager):
+    """Manager per i documenti di stabilimento"""
+    
+    def get_queryset(self):
+        """Stabilimento e utente in JOIN (usati da __str__ e liste)"""
+        return super().get_queryset().select_related('stabilimento', 'caricato_da')
+
+
 class DocStabilimento(models.Model):
     """
     Modello per la gestione di documenti generici legati agli stabilimenti.
@@ -641,6 +838,9 @@ class DocStabilimento(models.Model):
     data_inserimento = models.DateTimeField(auto_now_add=True)
     data_modifica = models.DateTimeField(auto_now=True)
     
+    # === MANAGER ===
+    objects = DocStabilimentoManager()
+    
     class Meta:
         verbose_name = "Documento Stabilimento"
         verbose_name_plural = "Documenti Stabilimenti"
@@ -649,23 +849,26 @@ class DocStabilimento(models.Model):
         indexes = [
             models.Index(fields=['stabilimento', 'tipo_documento']),
             models.Index(fields=['data_scadenza']),
-            models.Index(fields=['attivo']),
+            # Documenti attivi per intervallo di scadenza, già ordinati
+            models.Index(fields=['attivo', 'data_scadenza']),
+            # Documenti di uno stabilimento dal più recente (lista e dettaglio)
+            models.Index(fields=['stabilimento', '-data_inserimento'], name='doc_stab_recent_idx'),
         ]
     
     def __str__(self):
         return f"{self.nome_documento} v{self.versione} - {self.stabilimento.nome}"
     
     # === METODI INFORMATIVI ===
-    def is_scaduto(self):
+    def is_scaduto(self, oggi=None):
         """Verifica se il documento è scaduto"""
         if self.data_scadenza:
-            return self.data_scadenza < timezone.now().date()
+            return self.data_scadenza < (oggi or _oggi())
         return False
     
-    def giorni_alla_scadenza(self):
+    def giorni_alla_scadenza(self, oggi=None):
         """Restituisce i giorni rimanenti alla scadenza"""
         if self.data_scadenza:
-            delta = self.data_scadenza - timezone.now().date()
+            delta = self.data_scadenza - (oggi or _oggi())
             return delta.days
         return None
     
@@ -0,0 +1,93 @@
+"""
+Signal handlers dell'app stabilimenti.
+Mantengono allineate la cache delle choices usate nei form,
+quella delle dashboard scadenze/utenze, quella del dettaglio stabilimento
+e i conteggi delle liste utenze paginate.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from anagrafica.models import Fornitore
+from .cache import (
+    invalida_dashboard_cache, invalida_dettaglio_cache, invalida_conteggi_cache
+)
+from .forms import invalida_choices_cache
+from .models import Stabilimento, CostiStabilimento, DocStabilimento
+
+
+CHOICES_PER_MODELLO = {
+    Stabilimento: 'stabilimenti',
+    Fornitore: 'fornitori',
+    get_user_model(): 'responsabili',
+}
+
+
+@receiver([post_save, post_delete], sender=Stabilimento)
+@receiver([post_save, post_delete], sender=Fornitore)
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalida_choices_handler(sender, update_fields=None, **kwargs):
+    """
+    Invalida le choices in cache del modello salvato o eliminato
+    (stabilimenti, fornitori o responsabili). Il solo aggiornamento
+    di last_login a ogni accesso non cambia le etichette degli utenti.
+    """
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    invalida_choices_cache(CHOICES_PER_MODELLO[sender])
+
+
+@receiver([post_save, post_delete], sender=Stabilimento)
+@receiver([post_save, post_delete], sender=CostiStabilimento)
+@receiver([post_save, post_delete], sender=DocStabilimento)
+def invalida_dashboard_handler(sender, **kwargs):
+    """
+    Invalida i dati in cache delle dashboard quando cambiano
+    stabilimenti, costi o documenti.
+    """
+    invalida_dashboard_cache()
+
+
+@receiver(pre_save, sender=CostiStabilimento)
+@receiver(pre_save, sender=DocStabilimento)
+def memorizza_stabilimento_precedente(sender, instance, update_fields=None, **kwargs):
+    """
+    Salva sull'istanza lo stabilimento a cui apparteneva il costo/documento
+    prima della modifica, per invalidare anche il suo dettaglio se cambia.
+    """
+    instance._stabilimento_precedente_id = None
+    if instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and 'stabilimento' not in update_fields:
+        return
+    instance._stabilimento_precedente_id = sender._default_manager.filter(
+        pk=instance.pk
+    ).values_list('stabilimento_id', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Stabilimento)
+@receiver([post_save, post_delete], sender=CostiStabilimento)
+@receiver([post_save, post_delete], sender=DocStabilimento)
+def invalida_dettaglio_handler(sender, instance, **kwargs):
+    """
+    Invalida le sezioni in cache del dettaglio dello stabilimento
+    salvato o eliminato, o di quello a cui appartiene il costo/documento
+    (e di quello precedente, se il costo/documento è stato spostato).
+    """
+    if sender is Stabilimento:
+        invalida_dettaglio_cache(instance.pk)
+        return
+    invalida_dettaglio_cache(instance.stabilimento_id)
+    precedente = getattr(instance, '_stabilimento_precedente_id', None)
+    if precedente and precedente != instance.stabilimento_id:
+        invalida_dettaglio_cache(precedente)
+
+
+@receiver([post_save, post_delete], sender=CostiStabilimento)
+def invalida_conteggi_handler(sender, **kwargs):
+    """
+    Invalida i conteggi in cache delle liste paginate di utenze
+    quando un costo viene salvato o eliminato.
+    """
+    invalida_conteggi_cache()
@@ -0,0 +1,414 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from anagrafica.models import Fornitore
+from core.models import Promemoria
+from . import cache as cache_stabilimenti
+from .forms import UtenzaForm, fornitori_choices, responsabili_choices, stabilimenti_choices
+from .models import Stabilimento, CostiStabilimento, DocStabilimento
+from .views import _pagina_per_id
+
+
+# =====================================
+# DATI DI PROVA
+# =====================================
+
+def crea_utente(username='admin', **kwargs):
+    """Utente amministratore con accesso agli stabilimenti"""
+    kwargs.setdefault('livello', 'amministratore')
+    return get_user_model().objects.create_user(
+        username=username, password='password', first_name='Mario', last_name='Rossi', **kwargs
+    )
+
+
+def crea_collaboratore(username):
+    """Utente operativo senza password (niente hashing nei dati di volume)"""
+    return get_user_model().objects.create(username=username, livello='operativo')
+
+
+def crea_fornitore(nome='Fornitore'):
+    return Fornitore.objects.create(
+        nome=nome, telefono='0612345678', email='fornitore@example.com', partita_iva='01234567890'
+    )
+
+
+def crea_stabilimento(utente, nome='Stabilimento', **kwargs):
+    return Stabilimento.objects.create(
+        nome=nome, indirizzo='Via Roma 1', cap='00100', citta='Roma',
+        provincia='RM', creato_da=utente, **kwargs
+    )
+
+
+def crea_costo(stabilimento, utente, fornitore, **kwargs):
+    kwargs.setdefault('causale', 'altro')
+    kwargs.setdefault('titolo', 'Costo')
+    kwargs.setdefault('descrizione', 'Descrizione')
+    kwargs.setdefault('importo', Decimal('100.00'))
+    return CostiStabilimento.objects.create(
+        stabilimento=stabilimento, incaricato=utente, fornitore=fornitore, **kwargs
+    )
+
+
+def aggiungi_costi_e_documenti(stabilimento, utente):
+    """
+    Utenze, un costo generico e documenti in scadenza per uno stabilimento,
+    ognuno con incaricato e fornitore propri (le relazioni non lette in
+    blocco farebbero crescere le query con i dati)
+    """
+    oggi = timezone.localdate()
+    n = CostiStabilimento.objects.count()
+    for i, causale in enumerate(('altro', 'acqua', 'energia_elettrica')):
+        crea_costo(
+            stabilimento, crea_collaboratore(f'incaricato{n + i}'),
+            crea_fornitore(f'Fornitore {n + i}'), causale=causale, titolo=f'Costo {n + i}',
+            data_fattura=oggi, data_scadenza_servizio=oggi + timedelta(days=3 + 10 * i)
+        )
+    n = DocStabilimento.objects.count()
+    for i, giorni in enumerate((-2, 8, 18)):
+        DocStabilimento.objects.create(
+            stabilimento=stabilimento, caricato_da=crea_collaboratore(f'caricatore{n + i}'),
+            nome_documento=f'Documento {n + i}', versione='1.0', file_documento='documento.pdf',
+            data_scadenza=oggi + timedelta(days=giorni)
+        )
+
+
+def popola_stabilimenti(utente, quanti):
+    """Stabilimenti con responsabile, costi e documenti propri"""
+    stabilimenti = []
+    for _ in range(quanti):
+        n = Stabilimento.objects.count()
+        stabilimento = crea_stabilimento(
+            utente, nome=f'Stabilimento {n}',
+            responsabile_operativo=crea_collaboratore(f'responsabile{n}')
+        )
+        aggiungi_costi_e_documenti(stabilimento, utente)
+        stabilimenti.append(stabilimento)
+    return stabilimenti
+
+
+# =====================================
+# FORM
+# =====================================
+
+class UtenzaFormTest(TestCase):
+    """Label e help text specifici del form utenze"""
+    
+    def test_label_utenze_non_sovrascritte_dal_form_costi(self):
+        form = UtenzaForm()
+        self.assertEqual(form.fields['titolo'].label, "Descrizione Bolletta *")
+        self.assertEqual(form.fields['data_scadenza_servizio'].label, "Prossima Lettura")
+        self.assertEqual(
+            form.fields['data_scadenza_servizio'].help_text,
+            "Data della prossima lettura o scadenza contratto"
+        )
+        self.assertEqual(form.fields['fattura'].help_text, "Carica il PDF della bolletta")
+        self.assertEqual(form.fields['consumo_kwh'].label, "Consumo kWh")
+        self.assertFalse(form.fields['data_richiesta'].required)
+    
+    def test_label_nel_form_renderizzato(self):
+        html = UtenzaForm().as_p()
+        self.assertIn("Descrizione Bolletta *", html)
+        self.assertIn("Prossima Lettura", html)
+        self.assertNotIn("Prossima Scadenza", html)
+        self.assertNotIn("Data del prossimo intervento", html)
+
+
+# =====================================
+# CODICI PROGRESSIVI
+# =====================================
+
+class CodiciProgressiviTest(TestCase):
+    """Codici generati oltre la larghezza del padding (STB999 -> STB1000)"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = crea_utente()
+        cls.fornitore = crea_fornitore()
+    
+    def test_codice_stabilimento_oltre_999(self):
+        crea_stabilimento(self.utente, nome='A', codice_stabilimento='STB999')
+        self.assertEqual(crea_stabilimento(self.utente, nome='B').codice_stabilimento, 'STB1000')
+        self.assertEqual(crea_stabilimento(self.utente, nome='C').codice_stabilimento, 'STB1001')
+    
+    def test_numero_pratica_oltre_9999(self):
+        stabilimento = crea_stabilimento(self.utente)
+        prefisso = f"STB-{timezone.now().year}-"
+        crea_costo(stabilimento, self.utente, self.fornitore, numero_pratica=f"{prefisso}9999")
+        crea_costo(stabilimento, self.utente, self.fornitore, numero_pratica=f"{prefisso}10000")
+        costo = crea_costo(stabilimento, self.utente, self.fornitore)
+        self.assertEqual(costo.numero_pratica, f"{prefisso}10001")
+    
+    def test_assign_numero_pratica_batch(self):
+        stabilimento = crea_stabilimento(self.utente)
+        prefisso = f"STB-{timezone.now().year}-"
+        crea_costo(stabilimento, self.utente, self.fornitore, numero_pratica=f"{prefisso}9999")
+        crea_costo(stabilimento, self.utente, self.fornitore, numero_pratica=f"{prefisso}10000")
+        nuovi = [
+            CostiStabilimento(
+                stabilimento=stabilimento, incaricato=self.utente, fornitore=self.fornitore,
+                causale='altro', titolo=f'Batch {i}', descrizione='d', importo=Decimal('1.00')
+            )
+            for i in range(3)
+        ]
+        with self.assertNumQueries(2):
+            CostiStabilimento.objects.bulk_create(
+                CostiStabilimento.assign_numero_pratica_batch(nuovi)
+            )
+        self.assertEqual(
+            sorted(CostiStabilimento.objects.filter(titolo__startswith='Batch').values_list(
+                'numero_pratica', flat=True
+            )),
+            [f"{prefisso}10001", f"{prefisso}10002", f"{prefisso}10003"]
+        )
+    
+    def test_assign_numero_pratica_batch_una_query_per_lotto(self):
+        stabilimento = crea_stabilimento(self.utente)
+        nuovi = [
+            CostiStabilimento(
+                stabilimento=stabilimento, incaricato=self.utente, fornitore=self.fornitore,
+                causale='altro', titolo=f'Batch {i}', descrizione='d', importo=Decimal('1.00')
+            )
+            for i in range(50)
+        ]
+        with self.assertNumQueries(1):
+            CostiStabilimento.assign_numero_pratica_batch(nuovi)
+        self.assertEqual(len({costo.numero_pratica for costo in nuovi}), 50)
+
+
+# =====================================
+# CACHE
+# =====================================
+
+class CacheDashboardTest(TestCase):
+    """Le chiavi in cache cambiano versione quando i dati cambiano"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = crea_utente()
+    
+    def setUp(self):
+        cache.clear()
+    
+    def test_salvataggio_cambia_chiave_dashboard(self):
+        oggi = timezone.localdate()
+        chiave = cache_stabilimenti.chiave_dashboard('scadenze', oggi)
+        self.assertEqual(chiave, cache_stabilimenti.chiave_dashboard('scadenze', oggi))
+        
+        crea_stabilimento(self.utente)
+        
+        self.assertNotEqual(chiave, cache_stabilimenti.chiave_dashboard('scadenze', oggi))
+    
+    def test_versione_persa_non_riusa_chiavi_vecchie(self):
+        oggi = timezone.localdate()
+        chiave = cache_stabilimenti.chiave_dashboard('utenze', oggi)
+        cache.set(chiave, 'dati vecchi')
+        
+        # Versione espulsa dalla cache: la nuova non coincide con la precedente
+        cache.delete('stabilimenti:versione:dashboard')
+        
+        self.assertIsNone(cache.get(cache_stabilimenti.chiave_dashboard('utenze', oggi)))
+    
+    def test_salvataggio_costo_cambia_solo_il_proprio_dettaglio(self):
+        oggi = timezone.localdate()
+        stabilimento = crea_stabilimento(self.utente)
+        altro = crea_stabilimento(self.utente, nome='Altro')
+        chiave = cache_stabilimenti.chiave_dettaglio(stabilimento.pk, oggi)
+        chiave_altro = cache_stabilimenti.chiave_dettaglio(altro.pk, oggi)
+        
+        crea_costo(stabilimento, self.utente, crea_fornitore())
+        
+        self.assertNotEqual(chiave, cache_stabilimenti.chiave_dettaglio(stabilimento.pk, oggi))
+        self.assertEqual(chiave_altro, cache_stabilimenti.chiave_dettaglio(altro.pk, oggi))
+    
+    def test_costo_spostato_cambia_entrambi_i_dettagli(self):
+        oggi = timezone.localdate()
+        stabilimento = crea_stabilimento(self.utente)
+        altro = crea_stabilimento(self.utente, nome='Altro')
+        costo = crea_costo(stabilimento, self.utente, crea_fornitore())
+        chiave = cache_stabilimenti.chiave_dettaglio(stabilimento.pk, oggi)
+        chiave_altro = cache_stabilimenti.chiave_dettaglio(altro.pk, oggi)
+        
+        costo.stabilimento = altro
+        costo.save()
+        
+        self.assertNotEqual(chiave, cache_stabilimenti.chiave_dettaglio(stabilimento.pk, oggi))
+        self.assertNotEqual(chiave_altro, cache_stabilimenti.chiave_dettaglio(altro.pk, oggi))
+
+
+class CacheChoicesTest(TestCase):
+    """Le choices delle select restano in cache finché i signal non ne cambiano la versione"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = crea_utente()
+        cls.stabilimento = crea_stabilimento(cls.utente)
+    
+    def setUp(self):
+        cache.clear()
+    
+    def test_choices_in_cache_senza_query(self):
+        stabilimenti_choices()
+        with self.assertNumQueries(0):
+            choices = stabilimenti_choices()
+        self.assertEqual([pk for pk, _ in choices], [self.stabilimento.pk])
+    
+    def test_salvataggio_aggiorna_le_choices(self):
+        self.assertEqual(fornitori_choices(), [])
+        fornitore = crea_fornitore()
+        self.assertEqual(fornitori_choices(), [(fornitore.pk, fornitore.nome)])
+    
+    def test_responsabili_aggiornati_ma_non_dal_login(self):
+        responsabili_choices()
+        
+        self.client.login(username='admin', password='password')
+        with self.assertNumQueries(0):
+            responsabili_choices()
+        
+        self.utente.first_name = 'Luigi'
+        self.utente.save()
+        self.assertIn((self.utente.pk, 'Luigi Rossi'), responsabili_choices())
+
+
+# =====================================
+# PAGINAZIONE
+# =====================================
+
+class PaginaPerIdTest(TestCase):
+    
+    def test_riga_eliminata_tra_le_query_viene_saltata(self):
+        utente = crea_utente()
+        stabilimenti = [crea_stabilimento(utente, nome=f'Stabilimento {i}') for i in range(3)]
+        queryset = Stabilimento.objects.order_by('nome')
+        # righe non trova più il secondo, come se fosse stato eliminato nel frattempo
+        righe = Stabilimento.objects.exclude(pk=stabilimenti[1].pk)
+        
+        page_obj = _pagina_per_id(queryset, righe, 10, 1)
+        
+        self.assertEqual(list(page_obj.object_list), [stabilimenti[0], stabilimenti[2]])
+
+
+# =====================================
+# NUMERO DI QUERY
+# =====================================
+
+class NumeroQueryViewTest(TestCase):
+    """
+    Il numero di query delle pagine non cresce con i dati: ogni pagina
+    viene misurata a cache vuota, poi ripetuta con assertNumQueries dopo
+    aver aggiunto altri stabilimenti, costi e documenti
+    """
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = crea_utente()
+        cls.stabilimento = popola_stabilimenti(cls.utente, 2)[0]
+    
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.utente)
+    
+    def richiedi(self, url):
+        """GET a cache vuota; le risposte in streaming vengono lette per intero"""
+        cache.clear()
+        risposta = self.client.get(url)
+        if risposta.streaming:
+            b''.join(risposta.streaming_content)
+        self.assertEqual(risposta.status_code, 200)
+        return risposta
+    
+    def assertQueryCostanti(self, url):
+        with CaptureQueriesContext(connection) as query:
+            self.richiedi(url)
+        
+        popola_stabilimenti(self.utente, 3)
+        aggiungi_costi_e_documenti(self.stabilimento, self.utente)
+        
+        with self.assertNumQueries(len(query)):
+            return self.richiedi(url)
+    
+    def test_lista_stabilimenti(self):
+        self.assertQueryCostanti(reverse('stabilimenti:list'))
+    
+    def test_dettaglio_stabilimento(self):
+        self.assertQueryCostanti(reverse('stabilimenti:dettaglio', args=[self.stabilimento.pk]))
+    
+    def test_lista_costi(self):
+        self.assertQueryCostanti(reverse('stabilimenti:costi_list'))
+    
+    def test_dashboard_scadenze(self):
+        self.assertQueryCostanti(reverse('stabilimenti:scadenze'))
+    
+    def test_dashboard_scadenze_solo_conteggi(self):
+        risposta = self.assertQueryCostanti(reverse('stabilimenti:scadenze') + '?counts_only=1')
+        conteggi = risposta.json()
+        self.assertEqual(set(conteggi), {
+            'scadute', 'questa_settimana', 'prossimi_30_giorni', 'tutte_scadenze', 'totale_scadenze'
+        })
+    
+    def test_dashboard_utenze(self):
+        self.assertQueryCostanti(reverse('stabilimenti:dashboard_utenze'))
+    
+    def test_utenze_stabilimento(self):
+        self.assertQueryCostanti(
+            reverse('stabilimenti:utenze_stabilimento', args=[self.stabilimento.pk])
+        )
+    
+    def test_ricerca_utenze(self):
+        self.assertQueryCostanti(reverse('stabilimenti:ricerca_utenze'))
+    
+    def test_export_costi_csv(self):
+        risposta = self.assertQueryCostanti(reverse('stabilimenti:export_costi'))
+        self.assertTrue(risposta['Content-Type'].startswith('text/csv'))
+
+
+class ControllaScadenzeDocumentiTest(TestCase):
+    """Le esecuzioni ripetute del comando non duplicano i promemoria"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = crea_utente()
+        popola_stabilimenti(cls.utente, 2)
+    
+    def esegui(self):
+        call_command('controlla_scadenze_documenti', stdout=StringIO())
+    
+    def test_seconda_esecuzione_senza_duplicati(self):
+        self.esegui()
+        creati = Promemoria.objects.count()
+        # Due documenti in scadenza entro 30 giorni per stabilimento, un destinatario
+        self.assertEqual(creati, 4)
+        
+        with CaptureQueriesContext(connection) as query:
+            self.esegui()
+        self.assertEqual(Promemoria.objects.count(), creati)
+        
+        popola_stabilimenti(self.utente, 3)
+        self.esegui()
+        creati = Promemoria.objects.count()
+        self.assertEqual(creati, 10)
+        
+        with self.assertNumQueries(len(query)):
+            self.esegui()
+        self.assertEqual(Promemoria.objects.count(), creati)
+    
+    def test_documento_rinnovato_riceve_nuovo_promemoria(self):
+        self.esegui()
+        documento = DocStabilimento.objects.filter(promemoria__isnull=False).first()
+        documento.data_scadenza += timedelta(days=5)
+        documento.save()
+        
+        self.esegui()
+        
+        self.assertEqual(
+            Promemoria.objects.filter(documento=documento, completato=False).count(), 2
+        )
@@ -33,6 +33,9 @@ urlpatterns = [
     path('costi/', views.costi_list, name='costi_list'),
     # Template: stabilimenti/costi_list.html
     
+    # Export CSV dei costi (stessi filtri della lista)
+    path('costi/export/', views.export_costi_csv, name='export_costi'),
+    
     # ELIMINATO: Nuovo costo generico - ora tutti i costi devono avere uno stabilimento
     
     # Nuovo costo per uno stabilimento specifico
@@ -2,17 +2,32 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.core.cache import cache
 from django.db import transaction, models
-from django.http import JsonResponse
+from django.db.models import Count, Prefetch, Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.core.paginator import Paginator
 from datetime import timedelta
+from itertools import chain
+import csv
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
 
 from .models import Stabilimento, CostiStabilimento, DocStabilimento
 from .forms import (
     StabilimentoForm, CostiStabilimentoForm, DocStabilimentoForm,
-    StabilimentiSearchForm, CostiSearchForm, UtenzaForm
+    StabilimentiSearchForm, CostiSearchForm, UtenzaForm,
+    invalida_choices_cache
+)
+from .cache import (
+    DASHBOARD_CACHE_TIMEOUT, CONTEGGI_CACHE_TIMEOUT,
+    chiave_dashboard, chiave_dettaglio, chiave_conteggio,
+    invalida_dashboard_cache, invalida_dettaglio_cache
 )
 
 
@@ -33,6 +48,174 @@ def stabilimenti_access_required(user):
     return False
 
 
+# =====================================
+# PAGINAZIONE
+# =====================================
+
+class PaginatorConteggio(Paginator):
+    """
+    Paginator che conta le righe su un queryset separato, con gli stessi
+    filtri ma senza le annotazioni aggregate: il COUNT non ripete JOIN e
+    GROUP BY che servono solo alle colonne calcolate della pagina
+    """
+    
+    def __init__(self, object_list, per_page, conteggio, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.conteggio = conteggio
+    
+    @cached_property
+    def count(self):
+        return self.conteggio.count()
+
+
+class PaginatorConteggioCache(Paginator):
+    """
+    Paginator che tiene in cache per breve tempo il COUNT, con chiave
+    ricavata dall'SQL della query: le pagine successive della stessa
+    ricerca non lo ripetono. I signal sui costi invalidano i conteggi
+    """
+    
+    @cached_property
+    def count(self):
+        sql, params = self.object_list.query.sql_with_params()
+        impronta = hashlib.md5(f'{sql}|{params}'.encode()).hexdigest()
+        chiave = chiave_conteggio(impronta)
+        
+        conteggio = cache.get(chiave)
+        if conteggio is None:
+            conteggio = super().count
+            cache.set(chiave, conteggio, CONTEGGI_CACHE_TIMEOUT)
+        return conteggio
+
+
+def _pagina_per_id(queryset, righe, per_page, page_number, paginator_class=Paginator):
+    """
+    Pagina di un queryset ordinato con "join differito": COUNT, ordinamento
+    e OFFSET lavorano sui soli id, mentre le righe complete (JOIN e colonne
+    calcolate di righe) vengono lette solo per gli id della pagina
+    """
+    paginator = paginator_class(queryset.values_list('pk', flat=True), per_page)
+    page_obj = paginator.get_page(page_number)
+    ids = list(page_obj.object_list)
+    oggetti = righe.in_bulk(ids)
+    # Righe eliminate tra le due query: saltate invece di dare KeyError
+    page_obj.object_list = [oggetti[pk] for pk in ids if pk in oggetti]
+    return page_obj
+
+
+# =====================================
+# FILTRI DI RICERCA
+# =====================================
+
+# Campi dei form di ricerca filtrati per uguaglianza e lookup corrispondenti
+FILTRI_STABILIMENTI = {
+    'provincia': 'provincia__iexact',
+}
+FILTRI_COSTI = {
+    'stabilimento': 'stabilimento',
+    'causale': 'causale',
+    'stato': 'stato',
+    'fornitore': 'fornitore',
+    'anno': 'data_fattura__year',
+}
+
+
+def _filtri_da_form(cleaned_data, lookup):
+    """Lookup da passare a un unico filter() per i soli campi compilati"""
+    return {
+        lookup[campo]: valore
+        for campo, valore in cleaned_data.items()
+        if campo in lookup and valore
+    }
+
+
+def _filtra_costi(costi, form):
+    """Applica ai costi i filtri del form di ricerca (lista ed export)"""
+    if form.is_valid():
+        costi = costi.filter(**_filtri_da_form(form.cleaned_data, FILTRI_COSTI))
+        
+        scadenze_prossime = form.cleaned_data.get('scadenze_prossime')
+        if scadenze_prossime:
+            costi = costi.scadenze_prossime()
+    return costi
+
+
+# =====================================
+# SALVATAGGIO MODIFICHE
+# =====================================
+
+def _salva_modifiche(form, **valori):
+    """
+    Salva l'istanza di un ModelForm in modifica scrivendo solo le colonne
+    cambiate nel form, i valori di audit passati, i campi ricavati da save()
+    del form (campi_derivati) e quelli auto_now
+    """
+    istanza = form.save(commit=False)
+    for campo, valore in valori.items():
+        setattr(istanza, campo, valore)
+    
+    colonne = istanza._meta.concrete_fields
+    campi = {campo for campo in form.changed_data if campo in {c.name for c in colonne}}
+    campi.update(valori, getattr(form, 'campi_derivati', ()))
+    campi.update(c.name for c in colonne if getattr(c, 'auto_now', False))
+    
+    istanza.save(update_fields=campi)
+    form.save_m2m()
+    return istanza
+
+
+# =====================================
+# EXPORT CSV
+# =====================================
+
+# BOM iniziale perché Excel riconosca l'UTF-8
+CSV_BOM = '\ufeff'
+
+INTESTAZIONE_CSV_COSTI = [
+    'Numero Pratica', 'Stabilimento', 'Titolo', 'Tipologia', 'Stato', 'Fornitore',
+    'Importo', 'IVA %', 'Totale con IVA', 'Data Fattura', 'Scadenza Servizio',
+]
+
+
+class _RigaCSV:
+    """Pseudo-file per csv.writer: restituisce la riga invece di scriverla"""
+    
+    def write(self, valore):
+        return valore
+
+
+def _csv_testo(valore):
+    """Testo per CSV, con le formule neutralizzate (formula injection)"""
+    return "'" + valore if valore.startswith(('=', '+', '-', '@')) else valore
+
+
+def _csv_numero(valore):
+    """Importo in formato italiano (due decimali, virgola decimale)"""
+    return '' if valore is None else f'{valore:.2f}'.replace('.', ',')
+
+
+def _csv_data(valore):
+    """Data in formato italiano"""
+    return valore.strftime('%d/%m/%Y') if valore else ''
+
+
+def _riga_csv_costo(costo):
+    """Valori di un costo nell'ordine di INTESTAZIONE_CSV_COSTI"""
+    return [
+        costo.numero_pratica,
+        _csv_testo(costo.stabilimento.nome),
+        _csv_testo(costo.titolo),
+        costo.get_causale_display(),
+        costo.get_stato_display(),
+        _csv_testo(costo.fornitore.nome),
+        _csv_numero(costo.importo),
+        _csv_numero(costo.iva_percentuale),
+        _csv_numero(costo.totale_con_iva),
+        _csv_data(costo.data_fattura),
+        _csv_data(costo.data_scadenza_servizio),
+    ]
+
+
 # =====================================
 # VIEWS STABILIMENTI
 # =====================================
@@ -43,16 +226,30 @@ def stabilimenti_list(request):
     """Lista degli stabilimenti con filtri di ricerca"""
     form = StabilimentiSearchForm(request.GET or None)
     
-    # Query base
+    # Query base: solo le colonne mostrate in lista, che sono anche quelle
+    # del GROUP BY delle statistiche aggiunte prima della paginazione
     stabilimenti = Stabilimento.objects.select_related(
         'responsabile_operativo', 'responsabile_amministrativo'
+    ).only(
+        'nome', 'codice_stabilimento', 'indirizzo', 'citta', 'provincia',
+        'telefono', 'email_filiale', 'superficie_mq', 'numero_piani',
+        'anno_costruzione', 'attivo', 'data_apertura',
+        'responsabile_operativo__username',
+        'responsabile_operativo__first_name',
+        'responsabile_operativo__last_name',
+        'responsabile_amministrativo__username',
+        'responsabile_amministrativo__first_name',
+        'responsabile_amministrativo__last_name',
     )
     
-    # Applica filtri se il form è valido
+    # Applica filtri se il form è valido (un solo filter() per tutte le condizioni)
     if form.is_valid():
+        filtri = _filtri_da_form(form.cleaned_data, FILTRI_STABILIMENTI)
+        condizioni = []
+        
         q = form.cleaned_data.get('q')
         if q:
-            stabilimenti = stabilimenti.filter(
+            condizioni.append(
                 models.Q(nome__icontains=q) |
                 models.Q(codice_stabilimento__icontains=q) |
                 models.Q(citta__icontains=q) |
@@ -61,35 +258,41 @@ def stabilimenti_list(request):
         
         responsabile = form.cleaned_data.get('responsabile')
         if responsabile:
-            stabilimenti = stabilimenti.filter(
+            condizioni.append(
                 models.Q(responsabile_operativo=responsabile) |
                 models.Q(responsabile_amministrativo=responsabile)
             )
         
-        provincia = form.cleaned_data.get('provincia')
-        if provincia:
-            stabilimenti = stabilimenti.filter(provincia__iexact=provincia)
-        
         attivo = form.cleaned_data.get('attivo')
-        if attivo == 'true':
-            stabilimenti = stabilimenti.filter(attivo=True)
-        elif attivo == 'false':
-            stabilimenti = stabilimenti.filter(attivo=False)
+        if attivo in ('true', 'false'):
+            filtri['attivo'] = attivo == 'true'
+        
+        stabilimenti = stabilimenti.filter(*condizioni, **filtri)
     
     # Ordinamento
     stabilimenti = stabilimenti.order_by('nome')
     
-    # Paginazione
-    paginator = Paginator(stabilimenti, 20)
+    # Paginazione: costi dell'anno e scadenze urgenti calcolati nella stessa
+    # query della pagina, il totale contato senza JOIN sui costi
+    paginator = PaginatorConteggio(
+        stabilimenti.with_dashboard_stats(), 20, conteggio=stabilimenti
+    )
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
     
-    # Statistiche base
-    stats = {
-        'totali': Stabilimento.objects.count(),
-        'attivi': Stabilimento.objects.filter(attivo=True).count(),
-        'con_scadenze': Stabilimento.objects.con_scadenze_prossime().count(),
-    }
+    # Statistiche base: un solo aggregate, in cache (invalidata dai signal)
+    oggi = timezone.localdate()
+    chiave = chiave_dashboard('stabilimenti', oggi)
+    stats = cache.get(chiave)
+    
+    if stats is None:
+        con_scadenze = Stabilimento.objects.con_scadenze_prossime(oggi=oggi).values('pk')
+        stats = Stabilimento.objects.aggregate(
+            totali=Count('pk'),
+            attivi=Count('pk', filter=Q(attivo=True)),
+            con_scadenze=Count('pk', filter=Q(pk__in=con_scadenze)),
+        )
+        cache.set(chiave, stats, DASHBOARD_CACHE_TIMEOUT)
     
     context = {
         'form': form,
@@ -149,31 +352,69 @@ def nuovo_stabilimento(request):
 @user_passes_test(stabilimenti_access_required)
 def dettaglio_stabilimento(request, pk):
     """Dettaglio di un singolo stabilimento"""
-    stabilimento = get_object_or_404(
-        Stabilimento.objects.select_related(
-            'responsabile_operativo', 'responsabile_amministrativo', 'creato_da'
-        ),
-        pk=pk
-    )
-    
-    # Costi recenti
-    costi_recenti = stabilimento.costi.select_related('fornitore').order_by('-data_creazione')[:5]
+    # Data odierna calcolata una sola volta per tutta la pagina
+    oggi = timezone.localdate()
     
-    # Documenti recenti  
-    documenti_recenti = stabilimento.documenti.order_by('-data_inserimento')[:5]
-    
-    # Scadenze prossime (30 giorni)
-    scadenze_prossime = stabilimento.get_prossime_scadenze(30)
+    stabilimenti = Stabilimento.objects.select_related(
+        'responsabile_operativo', 'responsabile_amministrativo', 'creato_da'
+    )
     
-    # Statistiche costi anno corrente
-    costi_anno = stabilimento.get_costi_anno_corrente()
+    # Sezioni della pagina in cache (invalidate dai signal su stabilimento,
+    # costi e documenti): con la cache valida basta leggere lo stabilimento
+    chiave = chiave_dettaglio(pk, oggi)
+    sezioni = cache.get(chiave)
+    
+    if sezioni is None:
+        # Stabilimento con costi dell'anno annotati e, in un blocco di prefetch,
+        # costi recenti, documenti recenti e scadenze prossime (30 giorni).
+        # Le righe prefetchate sono già collegate allo stabilimento: niente JOIN
+        # su stabilimento/utenti, solo le colonne mostrate e il fornitore in JOIN
+        # (5 righe: più economico di una query di prefetch in più)
+        stabilimento = get_object_or_404(
+            stabilimenti.with_dashboard_stats(oggi=oggi).prefetch_related(
+                Prefetch(
+                    'costi',
+                    queryset=CostiStabilimento.objects.select_related(None).select_related(
+                        'fornitore'
+                    ).only(
+                        'titolo', 'causale', 'stato', 'data_creazione', 'stabilimento',
+                        'fornitore__nome',
+                    ).with_totals().order_by('-data_creazione')[:5],
+                    to_attr='costi_recenti'
+                ),
+                Prefetch(
+                    'documenti',
+                    queryset=DocStabilimento.objects.select_related(None).only(
+                        'nome_documento', 'tipo_documento', 'versione', 'data_scadenza',
+                        'data_inserimento', 'stabilimento',
+                    ).order_by('-data_inserimento')[:5],
+                    to_attr='documenti_recenti'
+                ),
+                Prefetch(
+                    'costi',
+                    queryset=CostiStabilimento.objects.select_related(None).only(
+                        'titolo', 'causale', 'data_scadenza_servizio', 'stabilimento',
+                    ).scadenze_prossime(30, oggi=oggi).order_by(
+                        'data_scadenza_servizio'
+                    ),
+                    to_attr='scadenze_prossime'
+                ),
+            ),
+            pk=pk
+        )
+        sezioni = {
+            'costi_recenti': stabilimento.costi_recenti,
+            'documenti_recenti': stabilimento.documenti_recenti,
+            'scadenze_prossime': stabilimento.scadenze_prossime,
+            'costi_anno': stabilimento.costi_anno,
+        }
+        cache.set(chiave, sezioni, DASHBOARD_CACHE_TIMEOUT)
+    else:
+        stabilimento = get_object_or_404(stabilimenti, pk=pk)
     
     context = {
         'stabilimento': stabilimento,
-        'costi_recenti': costi_recenti,
-        'documenti_recenti': documenti_recenti,
-        'scadenze_prossime': scadenze_prossime,
-        'costi_anno': costi_anno,
+        **sezioni,
         'page_title': f'Stabilimento {stabilimento.nome}',
         'breadcrumbs': [
             {'name': 'Stabilimenti', 'url': reverse('stabilimenti:list')},
@@ -195,9 +436,7 @@ def modifica_stabilimento(request, pk):
         
         if form.is_valid():
             try:
-                stabilimento_modificato = form.save(commit=False)
-                stabilimento_modificato.modificato_da = request.user
-                stabilimento_modificato.save()
+                _salva_modifiche(form, modificato_da=request.user)
                 
                 messages.success(request, f'Stabilimento "{stabilimento.nome}" modificato con successo')
                 return redirect('stabilimenti:dettaglio', pk=pk)
@@ -234,38 +473,22 @@ def costi_list(request):
     """Lista costi di tutti gli stabilimenti"""
     form = CostiSearchForm(request.GET or None)
     
-    # Query base
-    costi = CostiStabilimento.objects.select_related('stabilimento', 'fornitore', 'incaricato')
+    # Query base: solo le colonne mostrate in lista (niente note interne,
+    # allegati e consumi, né le colonne non usate delle relazioni)
+    costi = CostiStabilimento.objects.select_related('stabilimento', 'fornitore', 'incaricato').only(
+        'numero_pratica', 'titolo', 'descrizione', 'causale', 'stato',
+        'importo', 'iva_percentuale', 'data_fattura', 'data_scadenza_servizio', 'data_creazione',
+        'fattura', 'preventivo', 'certificato',
+        'stabilimento__nome', 'stabilimento__codice_stabilimento',
+        'fornitore__nome',
+        'incaricato__username', 'incaricato__first_name', 'incaricato__last_name',
+    )
     
-    # Applica filtri
-    if form.is_valid():
-        stabilimento = form.cleaned_data.get('stabilimento')
-        if stabilimento:
-            costi = costi.filter(stabilimento=stabilimento)
-        
-        causale = form.cleaned_data.get('causale')
-        if causale:
-            costi = costi.filter(causale=causale)
-        
-        stato = form.cleaned_data.get('stato')
-        if stato:
-            costi = costi.filter(stato=stato)
-        
-        fornitore = form.cleaned_data.get('fornitore')
-        if fornitore:
-            costi = costi.filter(fornitore=fornitore)
-        
-        scadenze_prossime = form.cleaned_data.get('scadenze_prossime')
-        if scadenze_prossime:
-            costi = costi.scadenze_prossime()
-        
-        anno = form.cleaned_data.get('anno')
-        if anno:
-            costi = costi.filter(data_fattura__year=anno)
-
-        
-    # Ordinamento
-    costi = costi.order_by('-data_creazione')
+    # Applica filtri (un solo filter() per i campi compilati)
+    costi = _filtra_costi(costi, form)
+    
+    # Ordinamento, totali ivati e fasce di scadenza calcolati dal database
+    costi = costi.order_by('-data_creazione').with_totals().with_scadenza_bucket()
     
     # Paginazione
     paginator = Paginator(costi, 25)
@@ -285,6 +508,35 @@ def costi_list(request):
     return render(request, 'stabilimenti/costi_list.html', context)
 
 
+@login_required
+@user_passes_test(stabilimenti_access_required)
+def export_costi_csv(request):
+    """Export CSV (formato italiano) dei costi con gli stessi filtri della lista"""
+    form = CostiSearchForm(request.GET or None)
+    
+    costi = _filtra_costi(
+        CostiStabilimento.objects.select_related(None).select_related(
+            'stabilimento', 'fornitore'
+        ).only(
+            'numero_pratica', 'titolo', 'causale', 'stato', 'importo', 'iva_percentuale',
+            'data_fattura', 'data_scadenza_servizio', 'stabilimento__nome', 'fornitore__nome',
+        ),
+        form
+    ).order_by('-data_creazione').with_totals()
+    
+    # Righe generate man mano che il database le restituisce (a blocchi):
+    # la memoria usata non dipende dal numero di costi esportati
+    writer = csv.writer(_RigaCSV(), delimiter=';')
+    righe = chain(
+        [CSV_BOM + writer.writerow(INTESTAZIONE_CSV_COSTI)],
+        (writer.writerow(_riga_csv_costo(costo)) for costo in costi.iterator(chunk_size=2000))
+    )
+    
+    response = StreamingHttpResponse(righe, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="costi_stabilimenti.csv"'
+    return response
+
+
 @login_required
 @user_passes_test(stabilimenti_access_required)
 def nuovo_costo(request, stabilimento_pk):
@@ -362,7 +614,7 @@ def modifica_costo(request, pk):
         
         if form.is_valid():
             try:
-                costo_modificato = form.save()
+                _salva_modifiche(form)
                 messages.success(request, f'Costo "{costo.titolo}" modificato con successo')
                 return redirect('stabilimenti:dettaglio_costo', pk=pk)
                 
@@ -399,7 +651,13 @@ def documenti_stabilimento(request, stabilimento_pk):
     """Lista documenti di uno stabilimento"""
     stabilimento = get_object_or_404(Stabilimento, pk=stabilimento_pk)
     
-    documenti = stabilimento.documenti.order_by('-data_inserimento')
+    # Lo stabilimento è già noto: in JOIN solo l'utente, con le colonne mostrate
+    documenti = stabilimento.documenti.select_related(None).select_related('caricato_da').only(
+        'nome_documento', 'tipo_documento', 'versione', 'descrizione', 'file_documento',
+        'data_documento', 'data_scadenza', 'attivo', 'note', 'data_inserimento',
+        'stabilimento',
+        'caricato_da__username', 'caricato_da__first_name', 'caricato_da__last_name',
+    ).order_by('-data_inserimento')
     
     # Paginazione
     paginator = Paginator(documenti, 20)
@@ -469,46 +727,85 @@ def nuovo_documento(request, stabilimento_pk):
 @user_passes_test(stabilimenti_access_required)
 def scadenze_dashboard(request):
     """Dashboard scadenze documenti di tutti gli stabilimenti"""
-    oggi = timezone.now().date()
-    
-    # Scadenze documenti per categoria temporale
-    scadute = DocStabilimento.objects.filter(
-        data_scadenza__lt=oggi,
-        attivo=True
-    ).select_related('stabilimento', 'caricato_da')
-    
-    questa_settimana = DocStabilimento.objects.filter(
-        data_scadenza__gte=oggi,
-        data_scadenza__lte=oggi + timedelta(days=7),
-        attivo=True
-    ).select_related('stabilimento', 'caricato_da')
-    
-    prossimi_30_giorni = DocStabilimento.objects.filter(
-        data_scadenza__gt=oggi + timedelta(days=7),
-        data_scadenza__lte=oggi + timedelta(days=30),
-        attivo=True
-    ).select_related('stabilimento', 'caricato_da')
-    
-    # DEBUG: Aggiungiamo statistiche per il debug
-    tutte_scadenze = DocStabilimento.objects.filter(
-        data_scadenza__isnull=False,
-        attivo=True
-    ).count()
-    
-    scadenze_future = DocStabilimento.objects.filter(
-        data_scadenza__gte=oggi,
-        attivo=True
-    ).count()
+    oggi = timezone.localdate()
+    limite_settimana = oggi + timedelta(days=7)
+    
+    # Solo i conteggi per categoria (widget di riepilogo): un unico aggregate
+    # con COUNT filtrati, senza leggere le righe dei documenti
+    if request.GET.get('counts_only'):
+        conteggi = DocStabilimento.objects.filter(attivo=True).aggregate(
+            scadute=Count('pk', filter=Q(data_scadenza__lt=oggi)),
+            questa_settimana=Count(
+                'pk', filter=Q(data_scadenza__gte=oggi, data_scadenza__lte=limite_settimana)
+            ),
+            prossimi_30_giorni=Count(
+                'pk', filter=Q(
+                    data_scadenza__gt=limite_settimana,
+                    data_scadenza__lte=oggi + timedelta(days=30)
+                )
+            ),
+            tutte_scadenze=Count('pk', filter=Q(data_scadenza__isnull=False)),
+        )
+        conteggi['totale_scadenze'] = (
+            conteggi['scadute'] + conteggi['questa_settimana'] + conteggi['prossimi_30_giorni']
+        )
+        return JsonResponse(conteggi)
+    
+    # Dati della dashboard in cache (invalidati dai signal su documenti e costi)
+    chiave = chiave_dashboard('scadenze', oggi)
+    dati = cache.get(chiave)
+    
+    if dati is None:
+        # Scadenze documenti per categoria temporale: una sola query (solo le
+        # colonne mostrate) letta a blocchi e suddivisa in Python
+        documenti = DocStabilimento.objects.filter(
+            data_scadenza__lte=oggi + timedelta(days=30),
+            attivo=True
+        ).only(
+            'nome_documento',
+            'tipo_documento',
+            'data_scadenza',
+            'stabilimento__nome',
+            'caricato_da__username',
+            'caricato_da__first_name',
+            'caricato_da__last_name',
+        )
+        
+        scadute = []
+        questa_settimana = []
+        prossimi_30_giorni = []
+        for documento in documenti.iterator(chunk_size=500):
+            if documento.data_scadenza < oggi:
+                scadute.append(documento)
+            elif documento.data_scadenza <= limite_settimana:
+                questa_settimana.append(documento)
+            else:
+                prossimi_30_giorni.append(documento)
+        
+        # DEBUG: Aggiungiamo statistiche per il debug (un solo aggregate)
+        conteggi = DocStabilimento.objects.filter(
+            data_scadenza__isnull=False,
+            attivo=True
+        ).aggregate(
+            tutte_scadenze=Count('pk'),
+            scadenze_future=Count('pk', filter=Q(data_scadenza__gte=oggi)),
+        )
+        
+        dati = {
+            'scadute': scadute,
+            'questa_settimana': questa_settimana,
+            'prossimi_30_giorni': prossimi_30_giorni,
+            'totale_scadenze': len(scadute) + len(questa_settimana) + len(prossimi_30_giorni),
+            'debug_info': {
+                'oggi': oggi,
+                'tutte_scadenze': conteggi['tutte_scadenze'],
+                'scadenze_future': conteggi['scadenze_future'],
+            },
+        }
+        cache.set(chiave, dati, DASHBOARD_CACHE_TIMEOUT)
     
     context = {
-        'scadute': scadute,
-        'questa_settimana': questa_settimana,
-        'prossimi_30_giorni': prossimi_30_giorni,
-        'debug_info': {
-            'oggi': oggi,
-            'tutte_scadenze': tutte_scadenze,
-            'scadenze_future': scadenze_future,
-        },
+        **dati,
         'page_title': 'Scadenze Documenti Stabilimenti',
         'breadcrumbs': [
             {'name': 'Stabilimenti', 'url': reverse('stabilimenti:list')},
@@ -529,23 +826,37 @@ def scadenze_dashboard(request):
 def toggle_attivo_stabilimento(request, pk):
     """Toggle stato attivo/inattivo stabilimento"""
     if request.method == 'POST':
-        stabilimento = get_object_or_404(Stabilimento, pk=pk)
-        
-        stabilimento.attivo = not stabilimento.attivo
-        if not stabilimento.attivo:
-            stabilimento.data_chiusura = timezone.now().date()
-        else:
-            stabilimento.data_chiusura = None
+        with transaction.atomic():
+            # Inverte lo stato con un solo UPDATE, senza caricare e risalvare
+            # l'istanza (nel SET le condizioni leggono i valori precedenti)
+            aggiornati = Stabilimento.objects.filter(pk=pk).update(
+                attivo=models.Case(
+                    models.When(attivo=True, then=models.Value(False)),
+                    default=models.Value(True)
+                ),
+                data_chiusura=models.Case(
+                    models.When(attivo=True, then=models.Value(timezone.localdate())),
+                    default=None
+                ),
+                modificato_da=request.user,
+                data_modifica=timezone.now()
+            )
+            if not aggiornati:
+                raise Http404('Stabilimento non trovato')
+            
+            attivo = Stabilimento.objects.filter(pk=pk).values_list('attivo', flat=True).get()
         
-        stabilimento.modificato_da = request.user
-        stabilimento.save()
+        # update() non invia post_save: invalida qui le cache come farebbero i signal
+        invalida_choices_cache('stabilimenti')
+        invalida_dashboard_cache()
+        invalida_dettaglio_cache(pk)
         
-        stato = "attivato" if stabilimento.attivo else "disattivato"
+        stato = "attivato" if attivo else "disattivato"
         messages.success(request, f'Stabilimento {stato} con successo')
         
         return JsonResponse({
             'success': True,
-            'attivo': stabilimento.attivo,
+            'attivo': attivo,
             'message': f'Stabilimento {stato}'
         })
     
@@ -554,56 +865,101 @@ def toggle_attivo_stabilimento(request, pk):
 # Aggiungi queste views al file stabilimenti/views.py esistente
 
 from decimal import Decimal
-from django.db.models import Q, Sum, Avg
+from django.db.models import Q, Sum, Avg, Value
+from django.db.models.functions import Coalesce
 from datetime import datetime, timedelta
 
 # =====================================
 # VIEWS UTENZE SPECIFICHE
 # =====================================
 
+# Causali che identificano un costo come utenza
+UTENZE_TYPES = frozenset({
+    'energia_elettrica', 'gas_naturale', 'acqua',
+    'telefonia', 'rifiuti', 'utilities',
+})
+
+# Etichette dei tipi di utenza, nell'ordine delle choices di TipoCosto
+UTENZE_DISPLAY = {
+    tipo_code: tipo_display
+    for tipo_code, tipo_display in CostiStabilimento.TipoCosto.choices
+    if tipo_code in UTENZE_TYPES
+}
+
+# Colonne delle utenze mostrate nelle liste (righe e prossime scadenze):
+# niente descrizione, note, allegati e colonne non usate delle relazioni
+COLONNE_LISTA_UTENZE = (
+    'numero_pratica', 'titolo', 'causale', 'stato', 'importo', 'iva_percentuale',
+    'data_fattura', 'data_scadenza_servizio', 'data_creazione',
+    'periodo_fatturazione_da', 'periodo_fatturazione_a',
+    'consumo_kwh', 'consumo_mc', 'codice_pdr_pod',
+    'stabilimento', 'fornitore__nome',
+)
+
+
+def _statistiche_anno(utenze, anno):
+    """
+    Totale, media e numero delle fatture dell'anno in un solo aggregate;
+    senza fatture il database restituisce zero invece di None
+    """
+    return utenze.filter(data_fattura__year=anno).aggregate(
+        totale_anno=Coalesce(Sum('importo'), Value(Decimal('0.00'))),
+        media_mensile=Coalesce(Avg('importo'), Value(Decimal('0.00'))),
+        count_fatture=models.Count('*')
+    )
+
+
+def _totali_per_tipo(utenze, anno):
+    """
+    Totali dell'anno per tipo di utenza con una sola query raggruppata per
+    causale: {etichetta: totale} nell'ordine di UTENZE_DISPLAY, zero per i
+    tipi senza costi
+    """
+    totali = dict(
+        utenze.filter(data_fattura__year=anno)
+        .order_by()
+        .values_list('causale')
+        .annotate(totale=Sum('importo'))
+    )
+    return {
+        tipo_display: totali.get(tipo_code, Decimal('0.00'))
+        for tipo_code, tipo_display in UTENZE_DISPLAY.items()
+    }
+
+
 @login_required
 @user_passes_test(stabilimenti_access_required)
 def utenze_stabilimento(request, stabilimento_pk):
     """Lista utenze di uno stabilimento specifico"""
     stabilimento = get_object_or_404(Stabilimento, pk=stabilimento_pk)
     
-    # Query per sole utenze
-    utenze_types = [
-        'energia_elettrica', 'gas_naturale', 'acqua', 
-        'telefonia', 'rifiuti', 'utilities'
-    ]
-    
+    # Query per sole utenze: lo stabilimento è già noto, in JOIN solo il
+    # fornitore mostrato in lista
     utenze = CostiStabilimento.objects.filter(
         stabilimento=stabilimento,
-        causale__in=utenze_types
-    ).select_related('fornitore', 'incaricato').order_by('-data_creazione')
+        causale__in=UTENZE_TYPES
+    ).select_related(None).select_related('fornitore').only(
+        *COLONNE_LISTA_UTENZE
+    ).order_by('-data_creazione')
     
     # Statistiche utenze anno corrente
-    anno_corrente = timezone.now().year
-    stats_anno = utenze.filter(data_fattura__year=anno_corrente).aggregate(
-        totale_anno=Sum('importo'),
-        media_mensile=Avg('importo'),
-        count_fatture=models.Count('id')
-    )
+    oggi = timezone.localdate()
+    anno_corrente = oggi.year
+    stats_anno = _statistiche_anno(utenze, anno_corrente)
     
     # Suddivisione per tipo utenza
-    stats_per_tipo = {}
-    for tipo_code, tipo_display in CostiStabilimento.TipoCosto.choices:
-        if tipo_code in utenze_types:
-            costi_tipo = utenze.filter(
-                causale=tipo_code,
-                data_fattura__year=anno_corrente
-            ).aggregate(totale=Sum('importo'))
-            stats_per_tipo[tipo_display] = costi_tipo['totale'] or Decimal('0.00')
-    
-    # Prossime scadenze utenze (60 giorni)
+    stats_per_tipo = _totali_per_tipo(utenze, anno_corrente)
+    
+    # Prossime scadenze utenze (60 giorni): solo tipo, fornitore e data mostrati
     prossime_scadenze = utenze.filter(
-        data_scadenza_servizio__gte=timezone.now().date(),
-        data_scadenza_servizio__lte=timezone.now().date() + timedelta(days=60)
+        data_scadenza_servizio__gte=oggi,
+        data_scadenza_servizio__lte=oggi + timedelta(days=60)
+    ).only(
+        'causale', 'data_scadenza_servizio', 'fornitore__nome'
     ).order_by('data_scadenza_servizio')[:5]
     
-    # Paginazione
-    paginator = Paginator(utenze, 15)
+    # Paginazione (totali ivati e fasce di scadenza calcolati dal database)
+    paginator = PaginatorConteggioCache(utenze.with_totals().with_scadenza_bucket(oggi=oggi), 15)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
     
@@ -634,23 +990,6 @@ def nuova_utenza(request, stabilimento_pk):
     if request.method == 'POST':
         form = UtenzaForm(request.POST, request.FILES, user=request.user, stabilimento=stabilimento)
         
-        # DEBUG: Stampa tutti i dati POST
-        print("=== DEBUG POST DATA ===")
-        for key, value in request.POST.items():
-            print(f"{key}: {value}")
-        print("=======================")
-        
-        # DEBUG: Controlla validità del form
-        print(f"Form valido: {form.is_valid()}")
-        if not form.is_valid():
-            print(f"Errori form: {form.errors}")
-            print(f"Errori non-field: {form.non_field_errors()}")
-            
-            # Mostra errori specifici per ogni campo
-            for field_name, field in form.fields.items():
-                if field_name in form.errors:
-                    print(f"Errore campo {field_name}: {form.errors[field_name]}")
-        
         if form.is_valid():
             try:
                 utenza = form.save(commit=False)
@@ -661,11 +1000,12 @@ def nuova_utenza(request, stabilimento_pk):
                 return redirect('stabilimenti:utenze_stabilimento', stabilimento_pk=stabilimento_pk)
                 
             except Exception as e:
-                print(f"ERRORE durante il salvataggio: {str(e)}")
-                import traceback
-                traceback.print_exc()
+                logger.exception(f"Errore salvataggio nuova utenza: {str(e)}")
                 messages.error(request, f'Errore durante la creazione: {str(e)}')
         else:
+            # Dettaglio degli errori solo con il livello DEBUG attivo
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Nuova utenza non valida: {form.errors.as_json()}")
             messages.error(request, 'Correggi gli errori nel form')
     
     else:
@@ -692,8 +1032,7 @@ def modifica_utenza(request, pk):
     utenza = get_object_or_404(CostiStabilimento, pk=pk)
     
     # Verifica che sia effettivamente un'utenza
-    utenze_types = ['energia_elettrica', 'gas_naturale', 'acqua', 'telefonia', 'rifiuti', 'utilities']
-    if utenza.causale not in utenze_types:
+    if utenza.causale not in UTENZE_TYPES:
         messages.error(request, 'Questo costo non è un\'utenza')
         return redirect('stabilimenti:dettaglio_costo', pk=pk)
     
@@ -706,7 +1045,19 @@ def modifica_utenza(request, pk):
         
         if form.is_valid():
             try:
-                utenza_modificata = form.save()
+                with transaction.atomic():
+                    # Riga bloccata fino al salvataggio: una modifica concorrente
+                    # attende, e un'utenza pagata nel frattempo non viene sovrascritta
+                    stato_attuale = CostiStabilimento.objects.select_for_update().filter(
+                        pk=pk
+                    ).values_list('stato', flat=True).get()
+                    if stato_attuale != CostiStabilimento.StatoCosto.PAGATO:
+                        _salva_modifiche(form)
+                
+                if stato_attuale == CostiStabilimento.StatoCosto.PAGATO:
+                    messages.error(request, 'Non è possibile modificare un\'utenza già pagata')
+                    return redirect('stabilimenti:dettaglio_costo', pk=pk)
+                
                 messages.success(request, f'Utenza "{utenza.titolo}" modificata con successo')
                 return redirect('stabilimenti:utenze_stabilimento', stabilimento_pk=utenza.stabilimento.pk)
                 
@@ -738,124 +1089,130 @@ def modifica_utenza(request, pk):
 @user_passes_test(stabilimenti_access_required)
 def dashboard_utenze(request):
     """Dashboard generale utenze di tutti gli stabilimenti"""
-    # Tipi di utenze
-    utenze_types = ['energia_elettrica', 'gas_naturale', 'acqua', 'telefonia', 'rifiuti', 'utilities']
+    oggi = timezone.localdate()
+    anno_corrente = oggi.year
+    
+    # Dati della dashboard in cache (invalidati dai signal su costi e stabilimenti)
+    chiave = chiave_dashboard('utenze', oggi)
+    dati = cache.get(chiave)
+    if dati is None:
+        dati = _dati_dashboard_utenze(oggi)
+        cache.set(chiave, dati, DASHBOARD_CACHE_TIMEOUT)
     
-    # Query base utenze
+    context = {
+        **dati,
+        'anno_corrente': anno_corrente,
+        'page_title': 'Dashboard Utenze',
+        'breadcrumbs': [
+            {'name': 'Stabilimenti', 'url': reverse('stabilimenti:list')},
+            {'name': 'Dashboard Utenze', 'url': None}
+        ]
+    }
+    
+    return render(request, 'stabilimenti/dashboard_utenze.html', context)
+
+
+def _dati_dashboard_utenze(oggi):
+    """Statistiche e scadenze della dashboard utenze"""
+    # Query base utenze (le prossime scadenze mostrano stabilimento e fornitore)
     utenze = CostiStabilimento.objects.filter(
-        causale__in=utenze_types
-    ).select_related('stabilimento', 'fornitore')
+        causale__in=UTENZE_TYPES
+    ).select_related(None).select_related('stabilimento', 'fornitore').only(
+        'causale', 'data_scadenza_servizio', 'stabilimento__nome', 'fornitore__nome'
+    )
     
     # Statistiche generali
-    anno_corrente = timezone.now().year
-    stats_generali = utenze.filter(data_fattura__year=anno_corrente).aggregate(
-        totale_anno=Sum('importo'),
-        media_mensile=Avg('importo'),
-        count_fatture=models.Count('id')
+    anno_corrente = oggi.year
+    stats_generali = _statistiche_anno(utenze, anno_corrente)
+    
+    # Costi per stabilimento (una query raggruppata, solo stabilimenti attivi con costi)
+    totali_stabilimento = dict(
+        utenze.filter(data_fattura__year=anno_corrente)
+        .order_by()
+        .values_list('stabilimento')
+        .annotate(totale=Sum('importo'))
     )
-    
-    # Costi per stabilimento
-    costi_per_stabilimento = {}
-    for stabilimento in Stabilimento.objects.attivi():
-        costo_stabilimento = utenze.filter(
-            stabilimento=stabilimento,
-            data_fattura__year=anno_corrente
-        ).aggregate(totale=Sum('importo'))['totale'] or Decimal('0.00')
-        
-        if costo_stabilimento > 0:
-            costi_per_stabilimento[stabilimento] = costo_stabilimento
+    costi_per_stabilimento = {
+        stabilimento: totali_stabilimento[stabilimento.pk]
+        for stabilimento in Stabilimento.objects.attivi().filter(
+            pk__in=totali_stabilimento
+        ).only('nome', 'codice_stabilimento', 'citta')
+        if totali_stabilimento[stabilimento.pk] > 0
+    }
     
     # Ordinamento per costo decrescente
     costi_per_stabilimento = dict(
         sorted(costi_per_stabilimento.items(), key=lambda x: x[1], reverse=True)
     )
     
-    # Suddivisione per tipo utenza (tutti gli stabilimenti)
-    stats_per_tipo = {}
-    for tipo_code, tipo_display in CostiStabilimento.TipoCosto.choices:
-        if tipo_code in utenze_types:
-            costi_tipo = utenze.filter(
-                causale=tipo_code,
-                data_fattura__year=anno_corrente
-            ).aggregate(totale=Sum('importo'))
-            
-            total = costi_tipo['totale'] or Decimal('0.00')
-            if total > 0:
-                stats_per_tipo[tipo_display] = total
+    # Suddivisione per tipo utenza (tutti gli stabilimenti, solo tipi con costi)
+    stats_per_tipo = {
+        tipo_display: totale
+        for tipo_display, totale in _totali_per_tipo(utenze, anno_corrente).items()
+        if totale > 0
+    }
     
     # Prossime scadenze utenze (30 giorni)
-    oggi = timezone.now().date()
-    prossime_scadenze = utenze.filter(
+    limite_urgenti = oggi + timedelta(days=7)
+    prossime_scadenze = list(utenze.filter(
         data_scadenza_servizio__gte=oggi,
         data_scadenza_servizio__lte=oggi + timedelta(days=30)
-    ).order_by('data_scadenza_servizio')[:10]
-    
-    # Utenze in scadenza urgente (7 giorni)
-    scadenze_urgenti = utenze.filter(
-        data_scadenza_servizio__gte=oggi,
-        data_scadenza_servizio__lte=oggi + timedelta(days=7)
-    ).count()
+    ).order_by('data_scadenza_servizio')[:10])
+    
+    # Utenze in scadenza urgente (7 giorni): le scadenze sono ordinate per data,
+    # quindi se la lista non è piena o va oltre i 7 giorni contiene già tutte
+    # le urgenti e il conteggio non richiede un'altra query
+    if len(prossime_scadenze) < 10 or prossime_scadenze[-1].data_scadenza_servizio > limite_urgenti:
+        scadenze_urgenti = sum(
+            1 for utenza in prossime_scadenze
+            if utenza.data_scadenza_servizio <= limite_urgenti
+        )
+    else:
+        scadenze_urgenti = utenze.filter(
+            data_scadenza_servizio__gte=oggi,
+            data_scadenza_servizio__lte=limite_urgenti
+        ).count()
     
-    context = {
+    return {
         'stats_generali': stats_generali,
         'costi_per_stabilimento': costi_per_stabilimento,
         'stats_per_tipo': stats_per_tipo,
         'prossime_scadenze': prossime_scadenze,
         'scadenze_urgenti': scadenze_urgenti,
-        'anno_corrente': anno_corrente,
-        'page_title': 'Dashboard Utenze',
-        'breadcrumbs': [
-            {'name': 'Stabilimenti', 'url': reverse('stabilimenti:list')},
-            {'name': 'Dashboard Utenze', 'url': None}
-        ]
     }
-    
-    return render(request, 'stabilimenti/dashboard_utenze.html', context)
 
 
 @login_required
 @user_passes_test(stabilimenti_access_required) 
 def ricerca_utenze(request):
     """Ricerca avanzata utenze con filtri specifici"""
-    utenze_types = ['energia_elettrica', 'gas_naturale', 'acqua', 'telefonia', 'rifiuti', 'utilities']
-    
     # Form di ricerca (riutilizziamo CostiSearchForm ma filtrato)
     form = CostiSearchForm(request.GET or None)
     
     # Query base
-    utenze = CostiStabilimento.objects.filter(
-        causale__in=utenze_types
-    ).select_related('stabilimento', 'fornitore', 'incaricato')
+    utenze = CostiStabilimento.objects.filter(causale__in=UTENZE_TYPES)
     
-    # Applica filtri
+    # Applica filtri (un solo filter(); causale solo se è un tipo di utenza)
     if form.is_valid():
-        stabilimento = form.cleaned_data.get('stabilimento')
-        if stabilimento:
-            utenze = utenze.filter(stabilimento=stabilimento)
-        
-        causale = form.cleaned_data.get('causale')
-        if causale and causale in utenze_types:
-            utenze = utenze.filter(causale=causale)
-        
-        stato = form.cleaned_data.get('stato')
-        if stato:
-            utenze = utenze.filter(stato=stato)
-        
-        fornitore = form.cleaned_data.get('fornitore')
-        if fornitore:
-            utenze = utenze.filter(fornitore=fornitore)
-        
-        anno = form.cleaned_data.get('anno')
-        if anno:
-            utenze = utenze.filter(data_fattura__year=anno)
-    
-    # Ordinamento
-    utenze = utenze.order_by('-data_fattura', '-data_creazione')
-    
-    # Paginazione
-    paginator = Paginator(utenze, 20)
+        filtri = _filtri_da_form(form.cleaned_data, FILTRI_COSTI)
+        if filtri.get('causale') not in UTENZE_TYPES:
+            filtri.pop('causale', None)
+        utenze = utenze.filter(**filtri)
+    
+    # Righe della pagina: solo le colonne mostrate, totali ivati e fasce di
+    # scadenza calcolati dal database
+    righe = CostiStabilimento.objects.select_related(None).select_related(
+        'stabilimento', 'fornitore'
+    ).only(
+        *COLONNE_LISTA_UTENZE, 'stabilimento__nome'
+    ).with_totals().with_scadenza_bucket()
+    
+    # Paginazione: ordinamento e OFFSET sui soli id
     page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = _pagina_per_id(
+        utenze.order_by('-data_fattura', '-data_creazione'), righe, 20, page_number,
+        paginator_class=PaginatorConteggioCache
+    )
     
     context = {
         'form': form,